@@ -0,0 +1,364 @@
+"""
+Бенчмарки бота на синтетических данных. Google Sheets и МойСклад не нужны:
+таблицы заменяет фейковый бэкенд из tests/fakes.py (FakeBackend, FakeSpreadsheet, FakeWorksheet)
+с настраиваемой задержкой и квотой, API МоегоСклада - локальный HTTP-сервер оттуда же.
+
+Запуск:
+    python benchmark.py
+"""
+
+import datetime
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import tracemalloc
+from collections import Counter
+from contextlib import redirect_stdout
+from time import perf_counter
+
+import xlrd
+
+from bot import (count_orders, parse_article, parse_money, compute_day_profit, read_excel_rows, run_jobs,
+                 ExcelReader, HistoryStore, Job, MoySkladAPI, Spreadsheet, SheetsClient, TokenBucket)
+from tests.fakes import (generate_rows, write_excel_export, serve_moysklad, import_time, fake_pool, FakeBackend,
+                         generate_calculation_sheet, generate_statistics_sheet, IMPORT_TIME_BUDGET, HEAVY_MODULES)
+
+
+def quadratic_frequency_dict(organizations_with_orders):
+
+    """
+    Старый алгоритм подсчета (вложенный цикл по всем парам), оставлен только для сравнения
+    """
+
+    frequency_dictionary = {}
+    for item in organizations_with_orders:
+        count = 0
+        for item2 in organizations_with_orders:
+            if item[1] == item2[1]:
+                count += 1
+        frequency_dictionary[item[1]] = count
+    return frequency_dictionary
+
+
+def timeit(function, *args):
+    start = perf_counter()
+    function(*args)
+    return perf_counter() - start
+
+
+def bench_frequency(sizes=(10_000, 100_000, 1_000_000), quadratic_limit=10_000):
+
+    """
+    Старый O(n²) подсчет против потокового count_orders.
+    Квадратичный вариант на больших объемах считается часами, поэтому выше quadratic_limit он пропускается
+    """
+
+    print('Частотный словарь')
+    print(f'{"строк":>10} {"O(n²), с":>12} {"count_orders, с":>16}')
+    for size in sizes:
+        rows = generate_rows(size)
+        quadratic = f'{timeit(quadratic_frequency_dict, rows):.3f}' if size <= quadratic_limit else 'пропуск'
+        linear = timeit(count_orders, iter(rows))
+        print(f'{size:>10} {quadratic:>12} {linear:>16.3f}')
+
+
+def per_order_profit(frequency_dictionary, margin_index):
+
+    """
+    Старый расчет прибыли по одному заказу за раз, оставлен только для сравнения
+    """
+
+    result = []
+    for (organization, order), count in frequency_dictionary.items():
+        if order not in margin_index:
+            continue
+        margin_order, price_order, share_order = margin_index[order]
+        try:
+            amount_margin_order = parse_money(margin_order) * count
+            amount_price_order = parse_money(price_order)
+        except ValueError:
+            continue
+        result.append((organization, order, round(amount_margin_order, 2), count, round(amount_price_order, 2), share_order))
+    return result
+
+
+def bench_profit(sizes=(10_000, 50_000, 200_000)):
+
+    """
+    Расчет прибыли за день: цикл по заказам против compute_day_profit
+    """
+
+    compute_day_profit({}, {}) # Импорт pandas не должен попадать в замер
+    print('Прибыль за день')
+    print(f'{"артикулов":>10} {"цикл, с":>10} {"pandas, с":>10}')
+    for size in sizes:
+        margin_index = {f'ART-{article}': (f'{article % 900 + 100},50 ₽', f'{article % 900 + 500}\xa0000 ₽', 'да')
+                            for article in range(size)}
+        frequency_dictionary = count_orders(generate_rows(size * 2, articles=size))
+
+        loop = timeit(per_order_profit, frequency_dictionary, margin_index)
+        vectorized = timeit(compute_day_profit, frequency_dictionary, margin_index)
+        print(f'{size:>10} {loop:>10.3f} {vectorized:>10.3f}')
+
+
+def column_scan_frequency_dict(path):
+
+    """
+    Старый путь ExcelReader: вся книга в память и две независимые выборки колонок (только .xls)
+    """
+
+    worksheet = xlrd.open_workbook(path).sheet_by_index(0)
+    organizations = [item for item in worksheet.col_values(2) if item != '']
+    orders = [parse_article(item) for item in worksheet.col_values(4) if item != '']
+    return count_orders(zip(organizations, orders))
+
+
+def bench_excel(sizes=(10_000, 60_000)):
+
+    """
+    Чтение выгрузок: старое сканирование колонок xlrd против потокового read_excel_rows.
+    .xls ограничен 65536 строками, поэтому большие объемы проверяются на .xlsx
+    """
+
+    print('Чтение Excel-выгрузок')
+    print(f'{"файл":>16} {"колонки xlrd, с":>16} {"read_excel_rows, с":>19}')
+    with tempfile.TemporaryDirectory() as folder:
+        for size in sizes:
+            for ext in ('xls', 'xlsx'):
+                path = os.path.join(folder, f'orders_{size}.{ext}')
+                write_excel_export(path, generate_rows(size))
+                columns = f'{timeit(column_scan_frequency_dict, path):.3f}' if ext == 'xls' else '-'
+                streaming = timeit(lambda: count_orders(read_excel_rows(path)))
+                print(f'{size:>10} {ext:>5} {columns:>16} {streaming:>19.3f}')
+
+
+def bench_moysklad_api(sizes=(10_000, 100_000)):
+
+    """
+    Загрузка заказов за день через MoySkladAPI с локального сервера
+    """
+
+    print('API МоегоСклада')
+    for size in sizes:
+        rows = generate_rows(size)
+        server = serve_moysklad(rows)
+        api = MoySkladAPI(token='fake', base_url=f'http://127.0.0.1:{server.server_port}')
+
+        start = perf_counter()
+        frequency_dictionary = api.get_frequency_dict('2022-01-01')
+        elapsed = perf_counter() - start
+        server.shutdown()
+
+        assert frequency_dictionary == count_orders(rows)
+        print(f'{size:>10} заказов: {elapsed:.2f} с')
+
+
+def bench_import_time():
+
+    """
+    Бюджет на холодный старт: import bot укладывается в IMPORT_TIME_BUDGET и не тянет тяжелые зависимости
+    """
+
+    loaded = subprocess.run([sys.executable, '-c', 'import sys, bot; print(" ".join(sorted(sys.modules)))'],
+                            capture_output=True, text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.split()
+    heavy = [module for module in HEAVY_MODULES if module in loaded]
+    assert not heavy, f'import bot загружает {heavy}'
+
+    bot_time = import_time('import bot')
+    dependencies_time = import_time('import selenium.webdriver, pandas, gspread, oauth2client.service_account, xlrd')
+    print(f'import bot: {bot_time * 1000:.1f} мс (бюджет {IMPORT_TIME_BUDGET * 1000:.0f} мс), '
+          f'тяжелые зависимости целиком: {dependencies_time * 1000:.1f} мс')
+    assert bot_time < IMPORT_TIME_BUDGET, 'import bot не укладывается в бюджет'
+
+
+def legacy_pipeline(calculation, statistics, frequency_dictionary, day):
+
+    """
+    Поячеечный путь исходной версии бота на фейковых таблицах: find/cell по каждой странице расчетов
+    на каждый артикул и find/findall/update_cell на каждый артикул в статистике. Нужен только для сравнения
+    """
+
+    worksheets = calculation.worksheets()
+    margin_orders = []
+    for order, count in frequency_dictionary.items():
+        for worksheet in worksheets:
+            row_order = worksheet.find(order)
+            if row_order is not None:
+                col_margin = worksheet.find('Маржа').col
+                col_price = worksheet.find('Итог (клиент)').col
+                col_share = worksheet.find('да/нет').col
+                margin = parse_money(worksheet.cell(row_order.row, col_margin).value) * count
+                price = parse_money(worksheet.cell(row_order.row, col_price).value)
+                share = worksheet.cell(row_order.row, col_share).value or ''
+                margin_orders.append((order, round(margin, 2), count, round(price, 2), share))
+                break
+
+    worksheet = statistics.get_worksheet(1)
+    for order, margin, count, price, share in margin_orders:
+        order_row = worksheet.find(order).row + 1
+        day_col = worksheet.find(day).col
+        for item in worksheet.findall(day):
+            if item.row == order_row - 2:
+                day_col = item.col
+                break
+        worksheet.update_cell(order_row, day_col, str(margin).replace('.', ','))
+        worksheet.update_cell(order_row - 1, day_col, count)
+        worksheet.update_cell(order_row + 1, day_col, str(price).replace('.', ','))
+        worksheet.update_cell(order_row + 2, day_col, share)
+
+
+def measure(function):
+
+    """
+    Время и пиковая память (tracemalloc) вызова function()
+    """
+
+    tracemalloc.start()
+    start = perf_counter()
+    try:
+        function()
+    finally:
+        elapsed = perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return elapsed, peak / 1024 / 1024
+
+
+def bench_pipeline(scales=(100, 1000, 5000), latency=0.01, quota=300, legacy_limit=100):
+
+    """
+    Полный путь Excel -> маржа -> статистика на фейковом бэкенде Google Sheets с задержкой latency
+    и квотой quota запросов в минуту. Для масштабов до legacy_limit артикулов рядом прогоняется исходный поячеечный путь
+    (без квоты: с ней он упирался бы в минутные паузы)
+    """
+
+    day = datetime.date(2022, 1, 15)
+    compute_day_profit({}, {}) # Импорт pandas не должен попадать в пиковую память первого замера
+    print(f'Excel -> маржа -> статистика (задержка {latency} с, квота {quota} запросов в минуту)')
+    print(f'{"артикулов":>10} {"путь":>10} {"запросов":>9} {"время, с":>9} {"пик, МБ":>8}  запросы по методам')
+    for articles in scales:
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'orders.xls')
+            write_excel_export(path, generate_rows(min(articles * 3, 60_000), articles=articles))
+
+            backend = FakeBackend(latency=latency, quota=quota)
+            calculation = generate_calculation_sheet(backend, sheets=12, articles=-(-articles // 12))
+            statistics = generate_statistics_sheet(backend, articles)
+            sheets_bot = Spreadsheet(SheetsClient(), pool=fake_pool(None, calculation, statistics),
+                                     history=HistoryStore(os.path.join(folder, 'history.sqlite3')))
+
+            def pipeline():
+                with redirect_stdout(open(os.devnull, 'w')):
+                    sheets_bot.run(ExcelReader().get_frequency_dict(path), day=day)
+
+            elapsed, peak = measure(pipeline)
+            print(f'{articles:>10} {"bot.py":>10} {backend.requests:>9} {elapsed:>9.2f} {peak:>8.1f}  {dict(backend.calls)}')
+
+            if articles > legacy_limit:
+                continue
+
+            legacy_backend = FakeBackend(latency=latency)
+            legacy_calculation = generate_calculation_sheet(legacy_backend, sheets=12, articles=-(-articles // 12))
+            legacy_statistics = generate_statistics_sheet(legacy_backend, articles)
+            by_article = Counter()
+            for (organization, order), count in ExcelReader().get_frequency_dict(path).items():
+                by_article[order] += count
+
+            elapsed, peak = measure(lambda: legacy_pipeline(legacy_calculation, legacy_statistics, by_article, str(day.day)))
+            print(f'{articles:>10} {"исходный":>10} {legacy_backend.requests:>9} {elapsed:>9.2f} {peak:>8.1f}  {dict(legacy_backend.calls)}')
+
+
+def bench_jobs(organizations=4, articles=300, latency=0.05):
+
+    """
+    Задания по organizations организациям, у каждой своя выгрузка, таблица расчетов и таблица статистики,
+    на одном фейковом бэкенде: по очереди и параллельно через run_jobs с общим пулом и общей квотой
+    """
+
+    day = datetime.date(2022, 1, 15)
+    compute_day_profit({}, {})
+    print(f'Задания по {organizations} организациям, {articles} артикулов у каждой, задержка ответа {latency} с')
+    cwd = os.getcwd()
+    for workers in (1, organizations):
+        with tempfile.TemporaryDirectory() as folder:
+            os.chdir(folder)
+            try:
+                backend = FakeBackend(latency=latency)
+                jobs, spreads = [], []
+                for number in range(organizations):
+                    os.makedirs(f'Excel{number}')
+                    write_excel_export(os.path.join(f'Excel{number}', 'orders.xls'), generate_rows(articles * 3, articles=articles))
+                    spreads.append(generate_calculation_sheet(backend, sheets=12, articles=-(-articles // 12), spread_id=f'calculation{number}'))
+                    spreads.append(generate_statistics_sheet(backend, articles, spread_id=f'statistics{number}'))
+                    jobs.append(Job(f'org{number}', folder=f'Excel{number}', calculation_id=f'calculation{number}',
+                                    statistics_id=f'statistics{number}'))
+
+                client = SheetsClient(bucket=TokenBucket(rate=600))
+                start = perf_counter()
+                with redirect_stdout(open(os.devnull, 'w')):
+                    errors = run_jobs(jobs, day=day, workers=workers, pool=fake_pool(client, *spreads))
+                elapsed = perf_counter() - start
+                assert not any(errors.values()), errors
+            finally:
+                os.chdir(cwd)
+
+            slowest = max(json.load(open(os.path.join(folder, str(day), f'metrics_{job.name}.json')))['phases']['total']
+                            for job in jobs)
+            print(f'{workers:>3} одновременно: {elapsed:.2f} с (самое долгое задание {slowest:.2f} с), '
+                  f'запросов к бэкенду: {backend.requests}')
+
+
+def bench_quota_retries(error_rate=0.3):
+
+    """
+    Построение индекса маржи через SheetsClient, когда бэкенд часто отвечает 429.
+    Задержки укорочены, чтобы прогон занимал секунды
+    """
+
+    backend = FakeBackend(error_rate=error_rate)
+    spread = generate_calculation_sheet(backend)
+    client = SheetsClient(bucket=TokenBucket(rate=600, period=1.0), max_retries=10, backoff_base=0.01, backoff_cap=0.1)
+    sheets = Spreadsheet(client)
+
+    start = perf_counter()
+    margin_index = sheets.build_margin_index(client.call('worksheets', spread.worksheets))
+    elapsed = perf_counter() - start
+
+    print(f'Ошибки квоты ({error_rate:.0%} ответов 429)')
+    print(f'Товаров в индексе: {len(margin_index)}, запросов к бэкенду: {backend.requests}, '
+          f'из них 429: {backend.errors}, время: {elapsed:.2f} с')
+    print('Счетчики клиента:', client.stats())
+    assert margin_index == sheets.build_margin_index(spread._worksheets), 'индекс маржи неполный'
+
+
+def bench_concurrent_scan(sheets=12, latency=0.5):
+
+    """
+    Последовательное и параллельное чтение страниц таблицы расчетов при задержке ответа latency секунд
+    """
+
+    print(f'Чтение {sheets} страниц таблицы расчетов, задержка ответа {latency} с')
+    for workers in (1, 4, 8):
+        backend = FakeBackend(latency=latency)
+        spread = generate_calculation_sheet(backend, sheets=sheets)
+        client = SheetsClient()
+        sheets_bot = Spreadsheet(client, scan_workers=workers)
+        worksheets = client.call('worksheets', spread.worksheets)
+
+        start = perf_counter()
+        sheets_bot.build_margin_index(worksheets)
+        print(f'{workers:>3} потоков: {perf_counter() - start:.2f} с')
+
+
+if __name__ == '__main__':
+    bench_import_time()
+    bench_frequency()
+    bench_profit()
+    bench_excel()
+    bench_moysklad_api()
+    bench_quota_retries()
+    bench_concurrent_scan()
+    bench_pipeline()
+    bench_jobs()
@@ -21,297 +21,1260 @@ II. Google Sheet API
 
 
 Дополнительная информация:
-    1. В боте используется система хранения историй работы бота, т.е создается директория с датой запуска бота,
-        куда будут сохранены файлы спарсенных данных и актуальной маржи товаров.
+    1. В боте используется система хранения историй работы бота: спарсенные данные и актуальная маржа товаров
+        сохраняются по дням в базу history.sqlite3 (см. HistoryStore), для каждого дня также создается директория с датой.
         В дальнейшем можно установить срок хранения истории (очищать ее через 3/6/9/12 месяцев)
 
-    2. Данный бот в текущей версии настроен на работу лишь с двумя организациями ИП Ермалович и ИП Александров.
-        Пока это имеет огромное значение, так как в некоторыъ блоках кода явно указываются эти организации
-        То есть в лпане работы с организациями бот ПОКА не универсален. 
+    2. По умолчанию бот работает с таблицами ИП Ермалович и ИП Александров (CALCULATION_SPREAD_ID, STATISTICS_SPREAD_ID).
+        Другие организации и аккаунты описываются заданиями в jobs.json (см. Job и load_jobs): у каждого задания
+        свой источник заказов, своя таблица расчетов и своя таблица статистики. Команда jobs выполняет все задания
+        параллельно в одном процессе с общим пулом подключений и общей квотой запросов к Google API.
+
+
+Запуск:
+    python bot.py excel                          # заказы из выгрузок в папке Excel
+    python bot.py selenium                       # заказы с сайта МоегоСклада через браузер
+    python bot.py api                            # заказы из API МоегоСклада
+    python bot.py backfill 2022-01-10 2022-01-16 # досчитать статистику за период
+    python bot.py jobs jobs.json                 # все организации из файла заданий параллельно
+"""
+
+
+
+
+# Тяжелые зависимости (selenium, pandas, gspread, oauth2client, xlrd, requests) импортируются лениво,
+# внутри функций, которым они нужны: запуск через Excel не должен платить за загрузку selenium и pandas
+
+from time import sleep, monotonic, perf_counter
+from contextlib import contextmanager
+import datetime, os
+import json
+import sqlite3
+import threading
+from collections import Counter, deque
+from random import choice, uniform
+
+
+def enable_console_colors():
+
+    """
+    Настройка цветного вывода в консоли
+    """
+
+    from sys import platform
+
+    if platform == 'win32':
+        import ctypes
+        kernel32 = ctypes.windll.kernel32
+        kernel32.SetConsoleMode(kernel32.GetStdHandle(-11), 7)
+
+
+def yesterday():
+    return datetime.date.today() - datetime.timedelta(days=1)
+
+
+def date_range(start, end):
+
+    """
+    Все дни от start до end включительно
+    """
+
+    return [start + datetime.timedelta(days=offset) for offset in range((end - start).days + 1)]
+
+
+def check_statistics_period(days):
+
+    """
+    Колонки дней в таблице статистики подписаны числом месяца, поэтому за один проход пишутся только дни одного месяца
+    """
+
+    months = {(day.year, day.month) for day in days}
+    if len(months) > 1:
+        raise ValueError('В таблице статистики колонки подписаны числом месяца, период должен лежать в одном месяце: '
+                         + ', '.join(f'{month:02}.{year}' for year, month in sorted(months)))
+
+
+def history_directory(day):
+
+    """
+    Директория истории за день
+    """
+
+    return os.path.join(os.getcwd(), str(day))
+
+
+# Декораторы для красивого и читабельного вывода в консоль, подсвечивают соответствующую информацию о состоянии работы бота
+success_message = '\033[2;30;42m [SUCCESS] \033[0;0m' 
+warning_message = '\033[2;30;43m [WARNING] \033[0;0m'
+
+def parse_article(comment):
+
+    """
+    Артикул товара записан в начале комментария к заказу, до первой запятой
+    """
+
+    return comment.split(',')[0].strip()
+
+
+def count_orders(rows):
+
+    """
+    Общий движок подсчета заказов для SeleniumParser и ExcelReader.
+    Принимает любой итерируемый объект пар (организация, артикул) и проходит по нему один раз,
+    поэтому строки можно отдавать потоком, не собирая их в список.
+    Ключ частотного словаря - пара (организация, артикул), чтобы один и тот же артикул
+    у разных ИП не склеивался в одно число
+    """
+
+    return Counter((organization.strip(), order.strip()) for organization, order in rows)
+
+
+class RunMetrics:
+    """
+    Метрики одного запуска бота: время по этапам, количество обработанных строк и, при выгрузке,
+    счетчики SheetsClient (запросы к Google API по типам, ожидание лимита, повторы).
+    Один экземпляр передается во все классы бота и выгружается в JSON и, по желанию, в textfile для Prometheus
+    """
+
+    def __init__(self):
+        self.timings = {}
+        self.rows = Counter()
+        self.lock = threading.Lock()
+
+
+    @contextmanager
+    def phase(self, name):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.timings[name] = self.timings.get(name, 0.0) + perf_counter() - start
+
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.rows[name] += amount
+
+
+    def report(self):
+        return ', '.join(f'{name} {seconds:.1f} с' for name, seconds in self.timings.items())
+
+
+    def to_dict(self, sheets_client=None):
+        with self.lock:
+            metrics = {
+                'finished_at': datetime.datetime.now().isoformat(timespec='seconds'),
+                'phases': {name: round(seconds, 3) for name, seconds in self.timings.items()},
+                'rows': dict(self.rows),
+            }
+        if sheets_client is not None:
+            metrics['sheets'] = sheets_client.stats()
+        return metrics
+
+
+    def write_json(self, filename, sheets_client=None):
+        with open(filename, 'w') as file:
+            json.dump(self.to_dict(sheets_client), file, ensure_ascii=False, indent=4)
+        print(success_message + '\tЗаписали метрики ' + filename)
+
+
+    def write_prometheus(self, filename, sheets_client=None):
+
+        """
+        Метрики в текстовом формате Prometheus для textfile collector node_exporter.
+        Файл пишется во временный и переименовывается, чтобы collector не прочитал его наполовину
+        """
+
+        metrics = self.to_dict(sheets_client)
+        lines = ['# TYPE statistics_bot_phase_seconds gauge']
+        lines += [f'statistics_bot_phase_seconds{{phase="{name}"}} {seconds}' for name, seconds in metrics['phases'].items()]
+        lines += ['# TYPE statistics_bot_rows gauge']
+        lines += [f'statistics_bot_rows{{counter="{name}"}} {amount}' for name, amount in metrics['rows'].items()]
+        if 'sheets' in metrics:
+            sheets = metrics['sheets']
+            lines += ['# TYPE statistics_bot_sheets_calls gauge']
+            lines += [f'statistics_bot_sheets_calls{{type="{kind}"}} {amount}' for kind, amount in sheets['calls_by_type'].items()]
+            lines += ['# TYPE statistics_bot_sheets_throttled_seconds gauge',
+                      f'statistics_bot_sheets_throttled_seconds {sheets["throttled_time"]}',
+                      '# TYPE statistics_bot_sheets_backoff_seconds gauge',
+                      f'statistics_bot_sheets_backoff_seconds {sheets["backoff_time"]}',
+                      '# TYPE statistics_bot_sheets_retries gauge',
+                      f'statistics_bot_sheets_retries {sheets["retried"]}']
+
+        with open(filename + '.tmp', 'w') as file:
+            file.write('\n'.join(lines) + '\n')
+        os.replace(filename + '.tmp', filename)
+
+
+MOYSKLAD_URL = 'https://online.moysklad.ru/'
+SELENIUM_WAIT_TIMEOUT = 30 # Сколько секунд ждем появления элементов на странице МоегоСклада
+SALES_MENU_XPATH = "//div[@class='topMenu-new']//td[@class='topMenuItem-new'][2]"
+ORDER_CELL_XPATH = "//td[contains(@class, 'cellTableCell')]"
+# Заглушка пустой таблицы. Если МойСклад ее не покажет, пустой считается таблица, в которой после обновления
+# за SELENIUM_WAIT_TIMEOUT не появилось ни одной строки
+EMPTY_TABLE_XPATH = "//td[contains(@class, 'cellTableEmpty')]"
+ORDER_ROWS_SCRIPT = """
+    // Считаем ячейки так же, как исходные XPath по точному классу 'cellTableCell cellTableEvenRowCell ':
+    // ячейки первой и последней колонок (с cellTableFirstColumn и cellTableLastColumn) пропускаются.
+    // Организация - третья из оставшихся ячеек строки, комментарий с артикулом - седьмая
+    return Array.from(document.querySelectorAll('tr')).map(function (row) {
+        return Array.from(row.children).filter(function (cell) {
+            var classes = cell.classList;
+            return cell.tagName === 'TD' && classes.contains('cellTableCell')
+                && (classes.contains('cellTableEvenRowCell') || classes.contains('cellTableOddRowCell'))
+                && !classes.contains('cellTableFirstColumn') && !classes.contains('cellTableLastColumn');
+        });
+    }).filter(function (cells) {
+        return cells.length >= 7;
+    }).map(function (cells) {
+        return [cells[2].innerText, cells[6].innerText];
+    });
 """
 
 
+EXCEL_EXTENSIONS = ('.xls', '.xlsx')
+EXCEL_ORGANIZATION_COL = 2 # Колонки выгрузки МоегоСклада (с нуля): организация и комментарий с артикулом
+EXCEL_COMMENT_COL = 4
+
+
+def read_excel_rows(path):
+
+    """
+    Потоково читаем выгрузку заказов построчно и отдаем пары (организация, артикул).
+    Из файла берутся только колонки организации и комментария и только первый лист:
+    .xls открывается через xlrd с загрузкой листов по требованию, .xlsx - через openpyxl в режиме только для чтения.
+    Строка попадает в результат, только если в ней заполнены обе колонки, поэтому пары не съезжают
+    """
+
+    if os.path.splitext(path)[1].lower() == '.xlsx':
+        from openpyxl import load_workbook # xlrd 2.x не читает .xlsx
+
+        workbook = load_workbook(path, read_only=True, data_only=True)
+        try:
+            rows = workbook.worksheets[0].iter_rows(min_col=EXCEL_ORGANIZATION_COL + 1, max_col=EXCEL_COMMENT_COL + 1, values_only=True)
+            for row in rows:
+                organization, comment = row[0], row[-1]
+                if organization not in (None, '') and comment not in (None, ''):
+                    yield str(organization), parse_article(str(comment))
+        finally:
+            workbook.close()
+        return
+
+    import xlrd
+
+    workbook = xlrd.open_workbook(path, on_demand=True)
+    try:
+        worksheet = workbook.sheet_by_index(0)
+        for row in range(worksheet.nrows):
+            organization = worksheet.cell_value(row, EXCEL_ORGANIZATION_COL)
+            comment = worksheet.cell_value(row, EXCEL_COMMENT_COL)
+            if organization != '' and comment != '':
+                yield str(organization), parse_article(str(comment))
+    finally:
+        workbook.release_resources()
+
+
+def parse_money(value):
+
+    """
+    Переводим денежную ячейку таблицы вида '1\xa0234,50 ₽' в число
+    """
+
+    return float(value.split('₽')[0].replace(',', '.').replace(u'\xa0', u''))
+
+
+def format_number(value):
+
+    """
+    Число для записи в таблицу с русской локалью: два знака после запятой и запятая вместо точки
+    """
+
+    return str(round(value, 2)).replace('.', ',')
+
+
+def parse_money_column(column):
+
+    """
+    То же, что parse_money, но сразу для целой колонки pandas. Неразборчивые значения становятся NaN.
+    Цены в таблице расчетов сильно повторяются, поэтому разбираем только различные значения и раскладываем их по кодам
+    """
+
+    import numpy as np
+    import pandas as pd
+
+    codes, uniques = pd.factorize(column)
+    numbers = pd.Series(uniques, dtype=object).str.split('₽').str[0].str.replace(',', '.').str.replace(u'\xa0', u'').str.strip()
+    parsed = np.append(pd.to_numeric(numbers, errors='coerce').to_numpy(dtype=float), np.nan) # codes == -1 -> NaN
+    return pd.Series(parsed[codes], index=column.index)
+
+
+DAY_PROFIT_COLUMNS = ['organization', 'article', 'profit', 'count', 'price', 'share']
+
+
+def compute_day_profit(frequency_dictionary, margin_index):
+
+    """
+    Прибыль за день по всем заказам сразу. Заказы (организация, артикул, количество) соединяются с индексом маржи
+    одним merge, денежные колонки разбираются в числа целиком, прибыль = маржа * количество считается по колонкам.
+    Возвращает таблицу с колонками DAY_PROFIT_COLUMNS в порядке заказов и список артикулов с неразборчивой маржой или ценой
+    """
+
+    import pandas as pd
+
+    orders = pd.DataFrame(
+        [(organization, order, count) for (organization, order), count in frequency_dictionary.items()],
+        columns=['organization', 'article', 'count'],
+    )
+    margins = pd.DataFrame(
+        [(order, margin, price, share) for order, (margin, price, share) in margin_index.items()],
+        columns=['article', 'margin', 'price', 'share'],
+    )
+
+    day = orders.merge(margins, on='article', how='inner', sort=False)
+    day['margin'] = parse_money_column(day['margin'])
+    day['price'] = parse_money_column(day['price'])
+
+    broken = day['margin'].isna() | day['price'].isna()
+    broken_orders = list(dict.fromkeys(day.loc[broken, 'article']))
+    day = day[~broken]
+
+    day['profit'] = (day['margin'] * day['count']).round(2)
+    day['price'] = day['price'].round(2)
+    return day[DAY_PROFIT_COLUMNS].reset_index(drop=True), broken_orders
+
+
+MARGIN_HEADERS = ('Маржа', 'Итог (клиент)', 'да/нет')
+BATCH_UPDATE_SIZE = 500 # Сколько диапазонов отправляем в одном batch_update
+MARGIN_SCAN_WORKERS = 8 # Сколько страниц таблицы расчетов читаем одновременно
+
+
+def index_margin_worksheet(values):
+
+    """
+    Индекс одной страницы таблицы расчетов по всем ее значениям (результат get_all_values).
+    Колонки 'Маржа', 'Итог (клиент)' и 'да/нет' ищутся один раз на страницу, как раньше это делал worksheet.find:
+    берется первое вхождение заголовка при обходе по строкам.
+    Ключ - любое значение ячейки строки, значение - (маржа, итог, да/нет) этой строки.
+    Если в странице нет хотя бы одного из заголовков, она пропускается
+    """
+
+    columns = {}
+    for row in values:
+        for col, value in enumerate(row):
+            if value in MARGIN_HEADERS and value not in columns:
+                columns[value] = col
+
+    if len(columns) != len(MARGIN_HEADERS):
+        return {}
+
+    col_margin, col_price, col_share = (columns[header] for header in MARGIN_HEADERS)
+
+    def cell(row, col):
+        return row[col] if col < len(row) else ''
+
+    index = {}
+    for row in values:
+        margin_order = cell(row, col_margin)
+        price_order = cell(row, col_price)
+        share_order = cell(row, col_share)
+        for value in row:
+            if value != '' and value not in index:
+                index[value] = (margin_order, price_order, share_order)
+
+    return index
+
+
+def plan_statistics_update(values, statistics_by_day):
+
+    """
+    План записи в таблицу статистики по ее значениям, прочитанным одним запросом.
+    Блок товара в таблице устроен так: строка над артикулом - числа месяца, строка с артикулом - количество,
+    ниже маржа, итог (клиент) и да/нет. Колонка дня берется из строки чисел над артикулом,
+    а если ее там нет - первое вхождение дня на странице, как раньше делали find и findall.
+    statistics_by_day: число месяца (строкой, как в таблице) -> {артикул: (маржа, количество, итог, да/нет)}.
+    Страница просматривается один раз на все дни.
+    Возвращает список ячеек (строка, колонка, значение) в нумерации gspread и список ненайденных артикулов
+    """
+
+    first_position = {}
+    day_cols = {}
+    for row_number, row in enumerate(values, start=1):
+        for col_number, value in enumerate(row, start=1):
+            first_position.setdefault(value, (row_number, col_number))
+            if value in statistics_by_day:
+                day_cols.setdefault((value, row_number), col_number)
+
+    cells = []
+    missing_orders = []
+    for day, statistics in statistics_by_day.items():
+        for order, (margin, count, price, share) in statistics.items():
+            if order not in first_position or day not in first_position:
+                missing_orders.append(order)
+                continue
+
+            order_count_row = first_position[order][0]
+            day_col = day_cols.get((day, order_count_row - 1), first_position[day][1])
+
+            cells.append((order_count_row, day_col, count))
+            cells.append((order_count_row + 1, day_col, margin))
+            cells.append((order_count_row + 2, day_col, price))
+            cells.append((order_count_row + 3, day_col, share))
+
+    return cells, list(dict.fromkeys(missing_orders))
+
+
+def cell_matches(values, row, col, value):
+
+    """
+    Совпадает ли значение ячейки (строка, колонка в нумерации gspread) в прочитанной странице с тем, что мы хотим записать.
+    Числа сравниваются как числа, потому что таблица показывает их в своем формате ('203' вместо '203,0')
+    """
+
+    current = values[row - 1][col - 1] if row <= len(values) and col <= len(values[row - 1]) else ''
+    if current == value:
+        return True
+
+    try:
+        return round(parse_money(current), 2) == round(parse_money(value), 2)
+    except ValueError:
+        return False
+
+
+def merge_margin_indexes(indexes):
+
+    """
+    Объединяем индексы страниц в один. Страницы перебираются по порядку,
+    и при повторе артикула побеждает первая страница, где он встретился
+    """
+
+    margin_index = {}
+    for index in indexes:
+        for order, row in index.items():
+            margin_index.setdefault(order, row)
+
+    return margin_index
+
+
+HISTORY_FILE = 'history.sqlite3'
+
+
+class HistoryStore:
+    """
+    История работы бота в одной базе SQLite вместо текстовых файлов в датированных директориях.
+    Таблицы типизированы и разбиты по дню (колонка day, YYYY-MM-DD), поэтому следующие этапы читают их
+    без разбора строк, а выборки за несколько месяцев идут одним запросом по индексу.
+    Спарсенные заказы и результат расчета маржи за день при перезапуске заменяются целиком
+    """
+
+    def __init__(self, filename=None):
+        self.filename = filename or os.path.join(os.getcwd(), HISTORY_FILE)
+        self.created = False # Файл базы создается при первом обращении, а не при создании объекта
+
+
+    def connect(self):
+        connection = sqlite3.connect(self.filename)
+        if not self.created:
+            connection.executescript(
+                'CREATE TABLE IF NOT EXISTS parsed_orders (day TEXT NOT NULL, organization TEXT NOT NULL, article TEXT NOT NULL);'
+                'CREATE INDEX IF NOT EXISTS parsed_orders_day ON parsed_orders (day);'
+                'CREATE TABLE IF NOT EXISTS margin_orders ('
+                'day TEXT NOT NULL, organization TEXT NOT NULL, article TEXT NOT NULL, '
+                'profit REAL NOT NULL, count INTEGER NOT NULL, price REAL NOT NULL, share TEXT NOT NULL);'
+                'CREATE INDEX IF NOT EXISTS margin_orders_day ON margin_orders (day);'
+                'CREATE INDEX IF NOT EXISTS margin_orders_article ON margin_orders (article, day);'
+                'CREATE TABLE IF NOT EXISTS pending_cells ('
+                'checkpoint TEXT NOT NULL, row INTEGER NOT NULL, col INTEGER NOT NULL, value TEXT NOT NULL, '
+                'PRIMARY KEY (checkpoint, row, col));'
+            )
+            self.created = True
+        return connection
+
+
+    def write_orders(self, day, rows):
+
+        """
+        Записываем пары (организация, артикул) за день одной транзакцией вместо прошлого парсинга этого дня,
+        чтобы повторный запуск не посчитал заказы дважды
+        """
+
+        with self.connect() as connection:
+            connection.execute('DELETE FROM parsed_orders WHERE day = ?', (day,))
+            connection.executemany('INSERT INTO parsed_orders VALUES (?, ?, ?)',
+                                   ((day, organization, article) for organization, article in rows))
+
+
+    def read_orders(self, day):
+
+        """
+        Потоково отдаем пары (организация, артикул) за день
+        """
+
+        with self.connect() as connection:
+            yield from connection.execute('SELECT organization, article FROM parsed_orders WHERE day = ? ORDER BY rowid', (day,))
+
+
+    def write_margin_orders(self, day, rows):
+
+        """
+        Заменяем результат расчета за день строками (организация, артикул, прибыль, количество, итог, да/нет)
+        """
+
+        with self.connect() as connection:
+            connection.execute('DELETE FROM margin_orders WHERE day = ?', (day,))
+            connection.executemany('INSERT INTO margin_orders VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                   ((day,) + tuple(row) for row in rows))
+
+
+    def read_day_statistics(self, day):
+
+        """
+        Итоги дня по артикулу: в таблице статистики одна строка на артикул, поэтому заказы разных ИП складываем.
+        Возвращает артикул -> (прибыль, количество, итог, да/нет)
+        """
+
+        with self.connect() as connection:
+            rows = connection.execute(
+                'SELECT article, SUM(profit), SUM(count), MAX(price), MAX(share) FROM margin_orders '
+                'WHERE day = ? GROUP BY article ORDER BY MIN(rowid)', (day,)
+            ).fetchall()
+
+        return {article: (profit, count, price, share) for article, profit, count, price, share in rows}
+
+
+    def save_pending_cells(self, checkpoint, cells):
+
+        """
+        Контрольная точка записи в таблицу: ячейки (строка, колонка, значение), которые еще предстоит записать.
+        checkpoint - ключ страницы таблицы, прежний список незаписанных ячеек этой страницы заменяется
+        """
+
+        with self.connect() as connection:
+            connection.execute('DELETE FROM pending_cells WHERE checkpoint = ?', (checkpoint,))
+            connection.executemany('INSERT OR REPLACE INTO pending_cells VALUES (?, ?, ?, ?)',
+                                   ((checkpoint, row, col, value) for row, col, value in cells))
+
+
+    def read_pending_cells(self, checkpoint):
+        with self.connect() as connection:
+            return connection.execute('SELECT row, col, value FROM pending_cells WHERE checkpoint = ? ORDER BY rowid',
+                                      (checkpoint,)).fetchall()
+
+
+    def clear_pending_cells(self, checkpoint, cells):
+        with self.connect() as connection:
+            connection.executemany('DELETE FROM pending_cells WHERE checkpoint = ? AND row = ? AND col = ?',
+                                   ((checkpoint, row, col) for row, col, value in cells))
+
+
+    def profit_by_article(self, start_day, end_day):
+
+        """
+        Прибыль и количество заказов по артикулам за период включительно, например за квартал
+        """
+
+        with self.connect() as connection:
+            return connection.execute(
+                'SELECT article, SUM(profit), SUM(count) FROM margin_orders '
+                'WHERE day BETWEEN ? AND ? GROUP BY article ORDER BY SUM(profit) DESC', (start_day, end_day)
+            ).fetchall()
+
+
+
+class NoExportsError(FileNotFoundError):
+    """
+    В папке нет выгрузок .xls/.xlsx
+    """
+
+
+
+class PaginationError(Exception):
+    """
+    Следующая страница таблицы заказов не открылась, хотя данные еще есть
+    """
+
+
+
+class SeleniumParser: 
+    
+    """
+    Этот класс выполняет первый блок вышеописанного алгоритма
+    """
+
+    def __init__(self, mysklag_login, mysklag_password, history=None, day=None, metrics=None):
+        self.password_user = mysklag_password
+        self.login_user = mysklag_login
+        self.day = str(day or yesterday())
+        self.metrics = metrics or RunMetrics()
+        self.history = history or HistoryStore()
+        self.parsed_rows = [] # Пары (организация, артикул) со всех страниц, в историю пишутся после последней
+
+
+    def start(self, url=MOYSKLAD_URL):
+
+        """
+        Этот метод подключает Chrome Webdriver вместе с необходимыми настройками(опциями) и подключается к url
+        """
+
+        from selenium import webdriver
+        from selenium.webdriver.common.by import By
+        from selenium.webdriver.chrome.options import Options
+        from selenium.webdriver.support.ui import WebDriverWait
+        from selenium.webdriver.support import expected_conditions as EC
+
+        print(warning_message + '\tЗапустили бота...')
+
+        option = Options()
+        
+        option.add_argument("--headless") # ФОНОВЫЙ РЕЖИМ   
+        # Отключаем всплывающие сообщения и окна браузера
+        option.add_argument("--disable-infobars") 
+        option.add_argument("start-maximized")
+        option.add_argument("--disable-extensions")
+        # option.add_experimental_option( "prefs",{'profile.managed_default_content_settings.javascript': 2}) # Отключение JavaScript
+        option.add_experimental_option('excludeSwitches', ['enable-logging']) # Исправление ошибок Selenium в Виндовс
+        option.add_experimental_option("prefs", { 
+            "profile.default_content_setting_values.notifications": 2
+        })
+
+        with self.metrics.phase('browser'):
+            self.browser = webdriver.Chrome(options=option)
+            self.browser.maximize_window()
+            self.wait = WebDriverWait(self.browser, SELENIUM_WAIT_TIMEOUT)
+            self.browser.get(url)
+            self.wait.until(EC.presence_of_element_located((By.ID, 'lable-login')))
+        print(success_message + '\tОткрыли сайт ', url)
+
+        try:
+            self.authorize(self.password_user, self.login_user)
+        finally:
+            print(success_message + '\tВремя по этапам: ' + self.metrics.report())
+
+    def authorize(self, user_password, user_login):
+
+        """
+        Метод авторизации на сайте 
+        """
+
+        from selenium.webdriver.common.by import By
+        from selenium.webdriver.support import expected_conditions as EC
+
+        with self.metrics.phase('login'):
+            login = self.browser.find_element(By.ID, 'lable-login')
+            login.send_keys(user_login)
+
+            password = self.browser.find_element(By.ID, 'lable-password')
+            password.send_keys(user_password)
+
+            button = self.browser.find_element(By.CLASS_NAME, 'b-button')
+            button.click()
+            self.wait.until(EC.element_to_be_clickable((By.XPATH, SALES_MENU_XPATH)))
+        print(success_message + '\tВошли в учетную запись...')
+
+        self.open_current_table()
+
+
+    def open_current_table(self):
+
+        """
+        настройка фильтров перед парсингом информации о заказах.
+        Вместо фиксированных пауз ждем появления нужных элементов
+        """
+
+        from selenium.webdriver.common.by import By
+        from selenium.webdriver.support import expected_conditions as EC
+
+        self.parsed_rows = []
+        with self.metrics.phase('filters'):
+            self.wait.until(EC.element_to_be_clickable((By.XPATH, SALES_MENU_XPATH))).click()
+
+            self.wait.until(EC.element_to_be_clickable((By.XPATH, "//div[@class='subMenuContainer-new']//span"))).click()
+            print(success_message + "\tОткрыли таблицу с заказами покупателей за вчерашнее число...")
+
+            self.wait.until(EC.element_to_be_clickable((By.XPATH, "//div[@class='period-filter-widget2-preset-label']"))).click()
+
+            # previos_arrow = self.browser.find_elements(By.XPATH, "//table[@class='mutable-panel-inner field']//div[@class='presets-panel-inner-left-arrow']")[0]
+            # previos_arrow.click()
+
+            tags_panels = self.wait.until(lambda browser: browser.find_elements(By.XPATH, "//div[@class='tags-panel']")[3:])
+            tags_panels[0].click()
+
+            all_checkbox_status = self.wait.until(EC.presence_of_all_elements_located((By.XPATH, "//td[@class='checkbox']")))
+            required_checkbox_status = all_checkbox_status[:6] + all_checkbox_status[-3:]
+            for checkbox in required_checkbox_status[:-1]:
+                checkbox.click()
+
+            first_row = self.first_table_row()
+            self.wait.until(EC.element_to_be_clickable((By.CLASS_NAME, "b-tool-button"))).click()
+            has_orders = self.wait_table_refresh(first_row)
+
+        if not has_orders:
+            print(warning_message + '\tЗа день нет заказов')
+            self.save_data()
+            return
+        self.scrape_pages()
+
+
+    def scrape_pages(self):
+
+        """
+        Парсим все страницы таблицы заказов. Конец данных (кнопки следующей страницы нет или она выключена)
+        отличается от сбоя: если страница не сменилась за SELENIUM_WAIT_TIMEOUT, бросаем PaginationError
+        """
+
+        from selenium.webdriver.common.by import By
+        from selenium.common.exceptions import TimeoutException
+
+        page = 1
+        while True:
+            with self.metrics.phase('parse'):
+                self.parse_data()
+
+            with self.metrics.phase('pagination'):
+                next_pages = self.browser.find_elements(By.XPATH, "//td[@class='next-page']//img[@class='gwt-Image']")
+                if not next_pages or not next_pages[0].is_displayed() or 'disabled' in (next_pages[0].get_attribute('class') or ''):
+                    print(success_message + f'\tСтраниц с заказами: {page}')
+                    self.save_data()
+                    return
+
+                first_row = self.first_table_row()
+                next_pages[0].click()
+                try:
+                    has_orders = self.wait_table_refresh(first_row)
+                except TimeoutException:
+                    has_orders = False
+                if not has_orders:
+                    raise PaginationError(f'Не открылась страница {page + 1} таблицы заказов')
+                page += 1
+
+
+    def first_table_row(self):
+
+        """
+        Первая ячейка таблицы заказов или None, если таблица пустая
+        """
+
+        from selenium.webdriver.common.by import By
+
+        cells = self.browser.find_elements(By.XPATH, ORDER_CELL_XPATH)
+        return cells[0] if cells else None
+
+
+    def wait_table_refresh(self, old_row):
+
+        """
+        Ждем, пока таблица перерисуется: старая строка пропадет из DOM и появятся новые строки или заглушка
+        пустой таблицы. Возвращает False, если таблица после обновления пустая: показана заглушка
+        или строки так и не появились. Если не пропала старая строка, бросаем TimeoutException
+        """
+
+        from selenium.webdriver.common.by import By
+        from selenium.webdriver.support import expected_conditions as EC
+        from selenium.common.exceptions import TimeoutException
+
+        if old_row is not None:
+            self.wait.until(EC.staleness_of(old_row))
+        try:
+            self.wait.until(lambda browser: browser.find_elements(By.XPATH, ORDER_CELL_XPATH)
+                                                or browser.find_elements(By.XPATH, EMPTY_TABLE_XPATH))
+        except TimeoutException:
+            return False
+        return bool(self.browser.find_elements(By.XPATH, ORDER_CELL_XPATH))
+
+
+    def parse_data(self):
+
+        """
+        Забираем всю видимую страницу таблицы одним вызовом execute_script: скрипт проходит по строкам
+        (и четным, и нечетным) в порядке их следования и возвращает пары (организация, комментарий).
+        Так на страницу уходит один запрос к WebDriver вместо запроса на каждую ячейку,
+        и организация остается в паре со своим комментарием
+        """
+
+        rows = self.browser.execute_script(ORDER_ROWS_SCRIPT)
+        self.metrics.count('selenium_rows', len(rows))
+        print(success_message + '\tСпарсили название организаций и комментарии к заказам...')   
+
+        self.parsed_rows.extend((organization.strip(), parse_article(comment)) for organization, comment in rows)
+
+
+    def save_data(self):
+        
+        """
+        Сохраняем спарсенные данные со всех страниц в историю. Если парсинг оборвался на середине
+        (например, PaginationError), история дня не меняется, а перезапуск не посчитает страницы дважды
+        """
+
+        self.history.write_orders(self.day, self.parsed_rows)
+        print(success_message + f'\tЗаписали в историю {len(self.parsed_rows)} заказов')
+
+
+    def get_frequency_dict(self):
+
+        """
+        Создаем частотный словарь
+        """
+
+        frequency_dictionary = count_orders(self.history.read_orders(self.day))
+
+        print(success_message + '\tОтсортировали собранные данные в частотный словарь')
+        return frequency_dictionary
 
 
-from time import sleep
-import datetime, os
-from random import choice
-import xlrd
 
+class ExcelReader:
+    """
+    Класс предусматривает работу с иксель файлом, содержащим полную информацию о заказах покупателей за предыдущий день.
+    Если пользователь при работе с ботом выберет вариант парсинга через иксель, ему нужно положить выгрузки .xls/.xlsx в папку Excel
+    """
+    def __init__(self, metrics=None):
+        """
+        Инициализация класса. Папка с выгрузками передается в open_excel
+        """
+
+        self.metrics = metrics or RunMetrics()
+        self.processed = [] # Прочитанные выгрузки, удаляются в remove_processed после успешного запуска
 
-from selenium import webdriver
-from selenium.webdriver.common.by import By
-from selenium.webdriver.chrome.options import Options
-import pandas as pd 
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials  
 
-# Настройка цветного вывода в консоли
-from sys import platform
+    def open_excel(self, folder_path='Excel'):
+
+        """
+        Обрабатываем все выгрузки .xls/.xlsx из папки и складываем их заказы в один частотный словарь.
+        Файлы не удаляются: если упадет чтение следующего файла или запись в таблицы, заказы не пропадут,
+        а удалить обработанные выгрузки нужно вызовом remove_processed после успешного запуска
+        """
 
-if platform == 'win32':
-    import ctypes
-    kernel32 = ctypes.windll.kernel32
-    kernel32.SetConsoleMode(kernel32.GetStdHandle(-11), 7)
+        files = [file for file in sorted(os.listdir(folder_path)) if os.path.splitext(file)[1].lower() in EXCEL_EXTENSIONS]
+        if not files:
+            raise NoExportsError(f'В папке {folder_path} нет excel-файлов')
 
+        freq_dict = Counter()
+        for file in files:
+            path = os.path.join(folder_path, file)
+            with self.metrics.phase('excel'):
+                file_dict = self.get_frequency_dict(path)
+            freq_dict.update(file_dict)
+            self.metrics.count('excel_files')
+            self.metrics.count('excel_rows', sum(file_dict.values()))
+            self.processed.append(path)
+            print(success_message + '\tОбработали файл ' + path)
 
-tomorrow = str((datetime.date.today() - datetime.timedelta(days=1)).day) # переменная для нахождения колонки вчерашнего дня в таблице статистики
-tomorrow_date = str(datetime.date.today() - datetime.timedelta(days=1)) # переменная для создания директорий
-parent_directory = os.getcwd()
-history_directory = os.path.join(parent_directory,tomorrow_date)
+        return freq_dict
 
-os.makedirs(history_directory, exist_ok=True) # Создаем директории истории за текущий день, если она не была создана 
 
-# Декораторы для красивого и читабельного вывода в консоль, подсвечивают соответствующую информацию о состоянии работы бота
-success_message = '\033[2;30;42m [SUCCESS] \033[0;0m' 
-warning_message = '\033[2;30;43m [WARNING] \033[0;0m'
+    def remove_processed(self):
 
-# parse_result_file =  f'{history_directory}/parser_result.txt'
+        """
+        Удаляем выгрузки, заказы из которых уже записаны в таблицу статистики
+        """
+
+        for path in self.processed:
+            os.remove(path)
+        print(success_message + f'\tУдалили обработанные выгрузки: {len(self.processed)}')
+        self.processed = []
+
+    def get_frequency_dict(self, path):
+        """
+        Частотный словарь одного файла
+        """
 
-# if os.path.exists(parse_result_file):
-    # os.remove(parse_result_file)
+        return count_orders(read_excel_rows(path))
 
 
-class SeleniumParser: 
-    
+
+
+MOYSKLAD_API_URL = 'https://api.moysklad.ru/api/remap/1.2'
+MOYSKLAD_PAGE_LIMIT = 1000 # Максимальный размер страницы выборки в API МоегоСклада (expand при нем не работает, только при limit <= 100)
+
+
+def order_states(value):
+
     """
-    Этот класс выполняет первый блок вышеописанного алгоритма
+    Статусы заказов из переменной окружения: названия через запятую, пустая или незаданная переменная - все заказы
     """
 
-    def __init__(self, mysklag_login, mysklag_password):
-        self.password_user = mysklag_password
-        self.login_user = mysklag_login
+    return tuple(state.strip() for state in (value or '').split(',') if state.strip())
 
 
-    def start(self):
+class MoySkladAPI:
+    """
+    Третий способ получить заказы покупателей: напрямую из JSON API МоегоСклада, без браузера.
+    Заказы за день забираются страницами по MOYSKLAD_PAGE_LIMIT штук через одну HTTP-сессию с пулом соединений,
+    фильтр по дате и статусам выполняет сам сервер. Организация в заказе приходит только ссылкой (meta.href),
+    названия организаций загружаются один раз за запуск.
+    Авторизация по токену или по логину и паролю
+    """
+
+    def __init__(self, login=None, password=None, token=None, states=(), base_url=None, metrics=None):
+        self.base_url = (base_url or MOYSKLAD_API_URL).rstrip('/')
+        self.metrics = metrics or RunMetrics()
+        self.states = states # Названия статусов заказов, которые учитываем. Пусто - все заказы
+        self.organizations = None # href организации -> название, загружается при первом заказе
+
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        self.session = requests.Session()
+        self.session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=4))
+        self.session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=4))
+        self.session.headers['Accept-Encoding'] = 'gzip'
+        if token:
+            self.session.headers['Authorization'] = f'Bearer {token}'
+        else:
+            self.session.auth = (login, password)
+
+
+    def order_filter(self, day):
 
         """
-        Этот метод подключает Chrome Webdriver вместе с необходимыми настройками(опциями) и подключается к url
+        Фильтр выборки: заказы за день day (YYYY-MM-DD) с нужными статусами.
+        Несколько условий на одно поле сервер объединяет через ИЛИ
         """
 
-        print(warning_message + '\tЗапустили бота...')
-        url = 'https://online.moysklad.ru/'
-        print(success_message + '\tОткрыли сайт ', url)
+        conditions = [f'moment>={day} 00:00:00', f'moment<={day} 23:59:59']
+        conditions += [f'state.name={state}' for state in self.states]
+        return ';'.join(conditions)
 
-        option = Options()
-        
-        option.add_argument("--headless") # ФОНОВЫЙ РЕЖИМ   
-        # Отключаем всплывающие сообщения и окна браузера
-        option.add_argument("--disable-infobars") 
-        option.add_argument("start-maximized")
-        option.add_argument("--disable-extensions")
-        # option.add_experimental_option( "prefs",{'profile.managed_default_content_settings.javascript': 2}) # Отключение JavaScript
-        option.add_experimental_option('excludeSwitches', ['enable-logging']) # Исправление ошибок Selenium в Виндовс
-        option.add_experimental_option("prefs", { 
-            "profile.default_content_setting_values.notifications": 2
-        })
 
+    def read_pages(self, entity, params=None):
+
+        """
+        Потоково отдаем все строки выборки entity, страница за страницей
+        """
+
+        params = dict(params or {}, limit=MOYSKLAD_PAGE_LIMIT, offset=0)
+        while True:
+            response = self.session.get(f'{self.base_url}/entity/{entity}', params=params, timeout=60)
+            response.raise_for_status()
+            page = response.json()
+            self.metrics.count('moysklad_api_pages')
 
-        self.browser = webdriver.Chrome(options=option)
-        self.browser.maximize_window()
-        self.browser.get(url)    
-        sleep(2)
+            yield from page['rows']
 
-        self.authorize(self.password_user, self.login_user)
+            params['offset'] += len(page['rows'])
+            if not page['rows'] or params['offset'] >= page['meta']['size']:
+                break
 
-    def authorize(self, user_password, user_login):
+
+    def organization_name(self, organization):
 
         """
-        Метод авторизации на сайте 
+        Название организации по ссылке из заказа. Все организации аккаунта читаются одним запросом,
+        а организация, которой нет в списке (например, созданная во время запуска), - отдельно по своему href
         """
 
-        login = self.browser.find_element(By.ID, 'lable-login')
-        login.send_keys(user_login)
+        href = organization['meta']['href']
+        if self.organizations is None:
+            self.organizations = {item['meta']['href']: item['name'] for item in self.read_pages('organization')}
+        if href not in self.organizations:
+            response = self.session.get(href, timeout=60)
+            response.raise_for_status()
+            self.organizations[href] = response.json()['name']
+        return self.organizations[href]
 
-        password = self.browser.find_element(By.ID, 'lable-password')
-        password.send_keys(user_password)
 
-        button = self.browser.find_element(By.CLASS_NAME, 'b-button')
-        button.click()
-        print(success_message + '\tВошли в учетную запись...')
-        sleep(6)
+    def read_rows(self, day=None):
 
-        self.open_current_table()
+        """
+        Потоково отдаем пары (организация, артикул) по всем страницам выборки
+        """
 
+        for order in self.read_pages('customerorder', {'filter': self.order_filter(day or str(yesterday()))}):
+            comment = order.get('description', '')
+            if comment:
+                yield self.organization_name(order['organization']), parse_article(comment)
 
-    def open_current_table(self):
+
+    def get_frequency_dict(self, day=None):
 
         """
-        настройка фильтров перед парсингом информации о заказах
+        Частотный словарь заказов за день
         """
 
-        button_sales = self.browser.find_element(By.XPATH, "//div[@class='topMenu-new']//td[@class='topMenuItem-new'][2]")
-        button_sales.click()
-        sleep(1)
+        with self.metrics.phase('moysklad_api'):
+            frequency_dictionary = count_orders(self.read_rows(day))
+        self.metrics.count('moysklad_api_rows', sum(frequency_dictionary.values()))
+        print(success_message + f'\tПолучили из API МоегоСклада {sum(frequency_dictionary.values())} заказов')
+        return frequency_dictionary
 
-        button_orders = self.browser.find_element(By.XPATH, "//div[@class='subMenuContainer-new']//span")
-        button_orders.click()
-        print(success_message + "\tОткрыли таблицу с заказами покупателей за вчерашнее число...")
-        sleep(3)
 
-        button_period = self.browser.find_element(By.XPATH, "//div[@class='period-filter-widget2-preset-label']")
-        button_period.click()
-        sleep(1)
 
-        # previos_arrow = self.browser.find_elements(By.XPATH, "//table[@class='mutable-panel-inner field']//div[@class='presets-panel-inner-left-arrow']")[0]
-        # previos_arrow.click()
-        # sleep(1)
+SHEETS_QUOTA_PER_MINUTE = 60 # Квота Google Sheets API на чтение/запись в минуту для одного пользователя
+RETRY_STATUSES = (429, 500, 502, 503, 504) # Ответы API, после которых запрос имеет смысл повторить
 
-        button_status = self.browser.find_elements(By.XPATH, "//div[@class='tags-panel']")[3]
-        button_status.click()
-        sleep(1)
 
-        all_checkbox_status = self.browser.find_elements(By.XPATH, "//td[@class='checkbox']")
-        required_checkbox_status = all_checkbox_status[:6] + all_checkbox_status[-3:]
-        for checkbox in required_checkbox_status[:-1]:
-            checkbox.click()
-    
-        sleep(4)
+class TokenBucket:
+    """
+    Ограничитель частоты запросов: не больше rate запросов за любые period секунд (скользящее окно).
+    Жетоном служит время запроса: новый запрос ждет, пока самый старый из последних rate запросов не выйдет из окна.
+    Обычный token bucket с емкостью rate пропускал бы пачку из rate запросов и еще столько же за следующие period секунд,
+    то есть до двух квот в одном окне Google. Потокобезопасный, чтобы его можно было делить между несколькими потоками
+    """
 
-        button_refresh = self.browser.find_element(By.CLASS_NAME, "b-tool-button")
-        button_refresh.click()
-        sleep(1)
-        self.parse_data()
+    def __init__(self, rate=SHEETS_QUOTA_PER_MINUTE, period=60.0):
+        self.capacity = rate
+        self.period = period
+        self.sent = deque() # Время последних запросов (monotonic), не больше capacity
+        self.lock = threading.Lock()
+
+
+    def acquire(self):
+
+        """
+        Забираем один жетон, при необходимости дожидаясь его. Возвращает время ожидания в секундах
+        """
+
+        waited = 0.0
         while True:
+            with self.lock:
+                now = monotonic()
+                while self.sent and now - self.sent[0] >= self.period:
+                    self.sent.popleft()
+                if len(self.sent) < self.capacity:
+                    self.sent.append(now)
+                    return waited
+                delay = self.period - (now - self.sent[0])
+
+            sleep(delay)
+            waited += delay
+
+
+
+class SheetsClient:
+    """
+    Единая точка, через которую Spreadsheet ходит в Google Sheets API.
+    Каждый запрос проходит через TokenBucket, а ответы 429/5xx повторяются
+    с экспоненциальной задержкой и случайным разбросом, но не больше max_retries раз.
+    Ведет счетчики запросов (по типам), ожиданий лимита и повторов с потраченным на них временем
+    """
+
+    def __init__(self, bucket=None, max_retries=6, backoff_base=1.0, backoff_cap=64.0):
+        self.bucket = bucket or TokenBucket()
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+
+        self.calls = Counter()
+        self.throttled = 0
+        self.throttled_time = 0.0
+        self.backoff_time = 0.0
+        self.retried = 0
+        self.lock = threading.Lock()
+
+
+    def call(self, kind, function, *args, **kwargs):
+
+        """
+        Выполняем function(*args, **kwargs) как один запрос к API типа kind
+        """
+
+        import gspread
+
+        for attempt in range(self.max_retries + 1):
+            waited = self.bucket.acquire()
+            with self.lock:
+                self.calls[kind] += 1
+                if waited:
+                    self.throttled += 1
+                    self.throttled_time += waited
+
             try:
-                next_page = self.browser.find_element(By.XPATH, "//td[@class='next-page']//img[@class='gwt-Image']")
-                next_page.click()
-                sleep(3)
-                self.parse_data()
+                return function(*args, **kwargs)
+            except gspread.exceptions.APIError as error:
+                if error.code not in RETRY_STATUSES or attempt == self.max_retries:
+                    raise
 
-            except BaseException:
-                break                
-    def parse_data(self):
+                delay = uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt))
+                print(warning_message + f'\tGoogle API ответил {error.code} на {kind}. Повтор через {delay:.1f} секунд.')
+                with self.lock:
+                    self.retried += 1
+                    self.backoff_time += delay
+                sleep(delay)
+
+
+    def stats(self):
 
         """
-        Нюанс данного метода заключается в том, что строки в таблице поделены
-        на четные и нечетные и поэтому приходится парсить обе строки по разному
-        После чего объединять всё воедино
+        Счетчики клиента для отчета о работе бота
         """
 
-        even_organizations = self.browser.find_elements(By.XPATH, "//td[@class='cellTableCell cellTableEvenRowCell '][3]")
-        odd_organizations = self.browser.find_elements(By.XPATH, "//td[@class='cellTableCell cellTableOddRowCell '][3]")
+        with self.lock:
+            return {
+                'calls': sum(self.calls.values()),
+                'calls_by_type': dict(self.calls),
+                'throttled': self.throttled,
+                'throttled_time': round(self.throttled_time, 2),
+                'backoff_time': round(self.backoff_time, 2),
+                'retried': self.retried,
+            }
 
 
-        all_organizations = even_organizations + odd_organizations
-        text_organizations = [item.text for item in all_organizations]
 
-        even_comments = self.browser.find_elements(By.XPATH, "//td[@class='cellTableCell cellTableEvenRowCell '][7]")
-        odd_comments = self.browser.find_elements(By.XPATH, "//td[@class='cellTableCell cellTableOddRowCell '][7]")
+KEYFILE = 'morbot-338716-b219142d9c70.json'
+SCOPE = ('https://www.googleapis.com/auth/spreadsheets', 'https://www.googleapis.com/auth/drive')
+TOKEN_REFRESH_MARGIN = datetime.timedelta(minutes=5) # Обновляем токен заранее, за столько времени до его истечения
 
-        print(success_message + '\tСпарсили название организаций и комментарии к заказам...')   
 
-        all_comments = even_comments + odd_comments
-        text_comments  = [item.text for item in all_comments]
+class ClientPool:
+    """
+    Общий на весь процесс пул подключений к Google Sheets.
+    Авторизованный клиент gspread (вместе с его HTTP-сессией с keep-alive) создается один раз на пару (ключ, scope),
+    открытые таблицы кэшируются по ID, а список страниц - по таблице.
+    Здесь же живет общий SheetsClient, так что лимит запросов один на все экземпляры Spreadsheet
+    """
 
-        id_orders = [item.split(',')[0] for item in text_comments]
+    def __init__(self, client=None):
+        self.client = client or SheetsClient()
+        self.clients = {}
+        self.spreads = {}
+        self.worksheet_lists = {}
+        self.loading = {} # Ключи, которые сейчас загружает один из потоков, -> Future с результатом
+        self.lock = threading.RLock()
 
-        print(success_message + '\tСохраняем собранные данные...')
 
-        self.save_data(text_organizations, id_orders)
+    def authorize(self, keyfile=KEYFILE, scope=SCOPE):
 
+        """
+        Авторизованный клиент gspread. Токен обновляется заранее, если до его истечения осталось меньше TOKEN_REFRESH_MARGIN.
+        gspread переводит учетные данные oauth2client в google-auth и ходит в API с ними (gc.http_client.auth),
+        поэтому срок действия проверяется и токен обновляется именно у них: сессия клиента берет токен оттуда
+        """
+
+        import gspread
+        from oauth2client.service_account import ServiceAccountCredentials
+        from google.auth.transport.requests import Request
+
+        with self.lock:
+            key = (keyfile, tuple(scope))
+            if key not in self.clients:
+                self.clients[key] = gspread.authorize(ServiceAccountCredentials.from_json_keyfile_name(keyfile, list(scope)))
+
+            gc = self.clients[key]
+            credentials = gc.http_client.auth
+            if credentials.expiry is not None and credentials.expiry - datetime.datetime.utcnow() < TOKEN_REFRESH_MARGIN:
+                credentials.refresh(Request())
+
+            return gc
+
+
+    def cached(self, cache, key, load):
 
-    def save_data(self, organizations, ids):
-        
         """
-        Сохраняем спарсенные данные в файлик parser_result.txt
+        Значение cache[key], при его отсутствии - load(). Запрос к API выполняется вне блокировки пула,
+        чтобы потоки, которым нужны другие таблицы, его не ждали. Остальные потоки с тем же ключом
+        ждут результат первого, а не повторяют запрос
         """
 
-        filename = f'{history_directory}/parser_result.txt'
+        from concurrent.futures import Future
 
-        with open(filename, 'a') as file:
-            for item in range(len(organizations)):
-                file.write(f'{organizations[item]} - {ids[item]} \n')
+        with self.lock:
+            if key in cache:
+                return cache[key]
+            future = self.loading.get((id(cache), key))
+            owner = future is None
+            if owner:
+                future = self.loading[(id(cache), key)] = Future()
 
-        print(success_message + '\tЗаписали файл ' + filename)
+        if owner:
+            try:
+                value = load()
+            except Exception as error:
+                with self.lock:
+                    del self.loading[(id(cache), key)] # Следующий вызов попробует снова
+                future.set_exception(error)
+                raise
+            with self.lock:
+                cache[key] = value
+                del self.loading[(id(cache), key)]
+            future.set_result(value)
 
+        return future.result()
 
-    def get_frequency_dict(self):
+
+    def open(self, spread_id, client=None, keyfile=KEYFILE, scope=SCOPE):
 
         """
-        Создаем частотный словарь
+        Открытая таблица по ID. open_by_key выполняется один раз за процесс для каждого аккаунта (ключа),
+        чтобы задания разных аккаунтов ходили в таблицу каждое со своей авторизацией
         """
 
-        organizations_with_orders = []
-        with open(f'{history_directory}/parser_result.txt', 'r') as file:
-            for line in file:
-                organization = line.split('-')[0]
-                order = line.split('-')[1].replace("\n", '').strip()
+        client = client or self.client
+        gc = self.authorize(keyfile, scope)
+        return self.cached(self.spreads, (keyfile, spread_id), lambda: client.call('open_by_key', gc.open_by_key, spread_id))
 
-                organizations_with_orders.append((organization, order))
 
+    def worksheets(self, spread, client=None):
+
+        """
+        Кэшированный список страниц таблицы
+        """
 
-        frequency_dictionary = {}
-        for item in organizations_with_orders:
-            count = 0
-            for item2 in organizations_with_orders:
-                if item[1] == item2[1]:
-                    count += 1
-            frequency_dictionary[item[1]] = count
+        client = client or self.client
+        # Таблицы живут в self.spreads до конца процесса, поэтому id не переиспользуется
+        return self.cached(self.worksheet_lists, id(spread), lambda: client.call('worksheets', spread.worksheets))
 
-        print(success_message + '\tОтсортировали собранные данные в частотный словарь')
-        return frequency_dictionary
 
+client_pool = ClientPool()
 
 
-class ExcelReader:
+MARGIN_CACHE_FILE = 'margin_cache.sqlite3'
+
+
+class MarginCache:
     """
-    Класс предусматривает работу с иксель файлом, содержащим полную информацию о заказах покупателей за предыдущий день.
-    Если пользователь при работе с ботом выберет вариант парсинга через иксель, ему нужно будет указать полный путь до файла с расширением .xml
+    Локальный кэш индекса маржи между запусками бота (SQLite рядом с бд истории).
+    Индекс хранится по каждой странице таблицы расчетов отдельно вместе с временем изменения
+    файла таблицы из метаданных Drive, на момент которого страница была прочитана.
+    Drive отдает время изменения только для файла целиком, поэтому страница считается актуальной,
+    пока не изменился файл и не поменялись ее название и размеры
     """
-    def __init__(self):
-        """
-        Инициализация класса. Просто принимаем путь до файла
-        """
 
+    def __init__(self, filename=None):
+        self.filename = filename or os.path.join(os.getcwd(), MARGIN_CACHE_FILE)
+        with sqlite3.connect(self.filename) as connection:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS margin_cache ('
+                'spread_id TEXT, sheet_id INTEGER, layout TEXT, modified_time TEXT, fetched_at TEXT, margin_index TEXT, '
+                'PRIMARY KEY (spread_id, sheet_id))'
+            )
 
-    def open_excel(self):
-        import os
-        folder_path = 'Excel'
 
-        for file in os.listdir(folder_path):
-            ext = file.split('.')[1]
-            if ext in ('xls', 'xlsx'):
-                self.workbook = xlrd.open_workbook(f"Excel/{file}")
-                self.worksheet = self.workbook.sheet_by_index(0)
-                try:
-                    freq_dict = self.get_frequency_dict()
-                except gspread.exceptions.APIError:
-                    print(warning_message + '\tБот устал и прилёг отдохнуть на минутку...')
-                    sleep(61)
-                    freq_dict = self.get_frequency_dict()
-                os.remove(f"Excel/{file}")
-                return freq_dict
+    @staticmethod
+    def layout(worksheet):
+        return f'{worksheet.title}|{worksheet.row_count}x{worksheet.col_count}'
 
-        print(warning_message + '\tВ папке нет excel-файлов')
-        quit()
 
-    def get_frequency_dict(self):
+    def get(self, spread_id, worksheet, modified_time):
+
         """
-        Частотный словарь 
+        Индекс страницы из кэша или None, если страницы нет в кэше или она могла измениться
         """
 
-        organizations = [item for item in self.worksheet.col_values(2) if item != '']
-        orders = [item.split(',')[0] for item in self.worksheet.col_values(4) if item != '']
-
-        organizations_with_orders = []
-        for item in range(len(orders)):
-            organizations_with_orders.append((organizations[item], orders[item]))
+        with sqlite3.connect(self.filename) as connection:
+            row = connection.execute(
+                'SELECT layout, modified_time, margin_index FROM margin_cache WHERE spread_id = ? AND sheet_id = ?',
+                (spread_id, worksheet.id)
+            ).fetchone()
 
-        frequency_dictionary = {}
-        for item in organizations_with_orders:
-            count = 0
-            for item2 in organizations_with_orders:
-                if item[1] == item2[1]:
-                    count += 1
-            frequency_dictionary[item[1]] = count
+        if row is None or row[0] != self.layout(worksheet) or row[1] != modified_time:
+            return None
+        return {value: tuple(margin_row) for value, margin_row in json.loads(row[2]).items()}
 
-        # print(frequency_dictionary)
-        return frequency_dictionary
 
+    def put(self, spread_id, worksheet, modified_time, index):
+        with sqlite3.connect(self.filename) as connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO margin_cache VALUES (?, ?, ?, ?, ?, ?)',
+                (spread_id, worksheet.id, self.layout(worksheet), modified_time,
+                    datetime.datetime.now().isoformat(timespec='seconds'), json.dumps(index, ensure_ascii=False))
+            )
 
 
 
+CALCULATION_SPREAD_ID = '1bGbNieNgqDNSORaphLhLOHUbIUE00yxA0q_b4HsNclM' # Таблица расчетов ИП Ермалович и ИП Александров
+STATISTICS_SPREAD_ID = '1rEGdqDGFzdaSAlTzjiFt-GlW-scgLx2-UDgQdN0PL_s' # Таблица статистики
+# STATISTICS_SPREAD_ID = '1J6EJ601kR_S1_sMDFk4ibzMaG5mEgWUMcV1e_jL67Qs'
+STATISTICS_WORKSHEET = 1 # Номер страницы статистики в таблице статистики
 
 
 class Spreadsheet:
@@ -319,21 +1282,68 @@ class Spreadsheet:
     Этот класс выполняет второй блок вышеописанного алгоритма
     """
 
-    def run(self, frequency_dictionary):
+    def __init__(self, client=None, pool=None, scan_workers=MARGIN_SCAN_WORKERS, margin_cache=None, refresh_margins=False,
+                 history=None, metrics=None, calculation_id=CALCULATION_SPREAD_ID, statistics_id=STATISTICS_SPREAD_ID,
+                 statistics_worksheet=STATISTICS_WORKSHEET, keyfile=KEYFILE, margin_indexes=None):
+        self.history = history or HistoryStore()
+        self.metrics = metrics or RunMetrics()
+        self.pool = pool or client_pool
+        self.client = client or self.pool.client
+        self.scan_workers = scan_workers # 1 - читать страницы таблицы расчетов по очереди
+        self.margin_cache = margin_cache # None - всегда читать таблицу расчетов целиком
+        self.refresh_margins = refresh_margins # Перечитать все страницы, не глядя в кэш
+        self.calculation_id = calculation_id
+        self.statistics_id = statistics_id
+        self.statistics_worksheet = statistics_worksheet
+        self.keyfile = keyfile # Ключ сервисного аккаунта Google, от имени которого открываются таблицы
+        self.margin_indexes = margin_indexes # Общий для заданий словарь ID таблицы -> Future индекса маржи
+
+
+    def run(self, frequency_dictionary, day=None):
+
+        """
+        Основной метод данного класса, объединяющий все остальные методы. По умолчанию считаем вчерашний день
+        """
+
+        self.backfill({day or yesterday(): frequency_dictionary})
+
+
+    def backfill(self, frequency_by_day):
 
         """
-        Основной метод данного класса, объединяющий все остальные методы
+        Расчет и запись статистики сразу за несколько дней: frequency_by_day - день (datetime.date) -> частотный словарь.
+        Индекс маржи строится один раз на все дни, а все колонки дней записываются в таблицу статистики одним проходом.
+        Дни без заказов пропускаются: пустой словарь обычно значит, что заказов за день нет в источнике,
+        и расчет не должен затирать уже сохраненный результат этого дня
         """
 
-        spread = self.auth_spread('1bGbNieNgqDNSORaphLhLOHUbIUE00yxA0q_b4HsNclM') # инициализация таблицы 
+        check_statistics_period(frequency_by_day)
+        for day, frequency_dictionary in frequency_by_day.items():
+            if not frequency_dictionary:
+                print(warning_message + f'\tЗа {day} нет заказов, день пропущен')
+        frequency_by_day = {day: frequency_dictionary for day, frequency_dictionary in frequency_by_day.items() if frequency_dictionary}
+        if not frequency_by_day:
+            return
+
+        spread = self.auth_spread(self.calculation_id) # инициализация таблицы 
 
         print(success_message + '\tПодключились к таблице расчетов')
-        first_org_margins = self.get_margin_by_organization(spread, frequency_dictionary) # Сбор маржи определенной организации
-        
-        # sleep(60) # Чтобы обойти лимит по количеству запросов Google API
+        with self.metrics.phase('margin_index'):
+            margin_index = self.shared_margin_index(spread)
+        for day, frequency_dictionary in frequency_by_day.items():
+            with self.metrics.phase('profit'):
+                first_org_margins = self.get_margin_by_organization(spread, frequency_dictionary, margin_index) # Сбор маржи определенной организации
+                self.save_result(first_org_margins, day)
+            self.metrics.count('articles', len(first_org_margins))
+
+        with self.metrics.phase('statistics'):
+            self.update_statistics_table(list(frequency_by_day))
 
-        # second_org_margins = self.get_margin_by_organization(spread, frequency_dictionary) # Сбор маржи определенной организации
-        self.save_result(first_org_margins)
+        stats = self.client.stats()
+        print(success_message + f'\tЗапросов к Google API: {stats["calls"]}, ожиданий лимита: {stats["throttled"]}, '
+                                f'повторов: {stats["retried"]}, в ожидании {stats["throttled_time"]} секунд, '
+                                f'на повторы {stats["backoff_time"]} секунд')
+        print(success_message + '\tВремя по этапам: ' + self.metrics.report())
 
 
     def auth_spread(self, spread_id):
@@ -342,89 +1352,170 @@ class Spreadsheet:
         Данный метод отвечает за подключение к таблице 
         """
 
-        scope = ['https://www.googleapis.com/auth/spreadsheets', 'https://www.googleapis.com/auth/drive']
-        credentials = ServiceAccountCredentials.from_json_keyfile_name('morbot-338716-b219142d9c70.json', scope)
+        return self.pool.open(spread_id, self.client, self.keyfile)
 
-        gc = gspread.authorize(credentials)
-        spread = gc.open_by_key(spread_id)
-        return spread
 
-
-    def get_margin_by_organization(self, spread, frequency_dictionary):
+    def get_margin_by_organization(self, spread, frequency_dictionary, margin_index=None):
 
         """
         СОбираем маржу и высчитываем общую прибыль
         """
 
         # worksheet = self.open_worksheet(spread, organization) # открываем нужную страницу, полагаясь на название организации
-        spread = self.auth_spread('1bGbNieNgqDNSORaphLhLOHUbIUE00yxA0q_b4HsNclM')
-        worksheets = spread.worksheets()   
-        organization_margin_orders = []
-
-        
-        def collect_margin_orders(order):
-            try:
-                for worksheet in worksheets:
-
-                    row_order = worksheet.find(str(order))
-                    if row_order != None:
-                        # print(order, worksheet)
-                        col_margin = worksheet.find('Маржа').col
-                        col_price = worksheet.find('Итог (клиент)').col
-                        col_share = worksheet.find('да/нет').col
-                    
-                        margin_order = worksheet.cell(row_order.row, col_margin).value
-                        price_order = worksheet.cell(row_order.row, col_price).value
-                        share_order = worksheet.cell(row_order.row, col_share).value
-                        if share_order == None:
-                            share_order = ''
-                
-                        amount_margin_order = float(margin_order.split('₽')[0].replace(',', '.').replace(u'\xa0', u'')) * frequency_dictionary[order]
-                        amount_price_order = float(price_order.split('₽')[0].replace(',', '.').replace(u'\xa0', u''))        
-
-                        organization_margin_orders.append((order, round(amount_margin_order, 2), frequency_dictionary[order],
-                                                                round(amount_price_order, 2), share_order))
-                        break # Перестаем бегать по страницам
-            except gspread.exceptions.APIError:
-                print(warning_message + '\tБот превысил лимит запросов. Автоматически продолжит работу через 20 секунд.')
-                sleep(20)
-                collect_margin_orders(order)
+        if margin_index is None:
+            margin_index = self.load_margin_index(spread)
 
         print(success_message + '\tПроверяем доступную информацию о товарах.')
-        for order in frequency_dictionary:
-           collect_margin_orders(order) 
-           
+        day_profit, broken_orders = compute_day_profit(frequency_dictionary, margin_index)
+        for order in broken_orders:
+            print(warning_message + f'\tНе удалось разобрать маржу или цену товара {order}')
+
+        organization_margin_orders = list(day_profit.itertuples(index=False, name=None))
+
         print(success_message + '\tСобрали информацию по товарам.')
         return organization_margin_orders
     
 
-    def save_result(self, first_org):
+    def load_margin_index(self, spread):
 
         """
-        сохраняем результат для истории
+        Индекс маржи с учетом локального кэша: из таблицы читаются только страницы,
+        которых нет в кэше или которые могли измениться с прошлого запуска
         """
 
-        filename = f'{history_directory}/margin_orders.txt'
+        worksheets = self.pool.worksheets(spread, self.client)
+        if self.margin_cache is None:
+            return self.build_margin_index(worksheets)
 
-        with open(filename, 'w') as file:
-            for item in first_org:
-                file.write(f'{item[0]} - {item[1]}  - {item[2]} - {item[3]} - {item[4]} \n')
+        modified_time = self.client.call('get_lastUpdateTime', spread.get_lastUpdateTime)
+        indexes = [None if self.refresh_margins else self.margin_cache.get(spread.id, worksheet, modified_time)
+                        for worksheet in worksheets]
+
+        stale = [number for number, index in enumerate(indexes) if index is None]
+        fresh_indexes = self.scan_worksheets([worksheets[number] for number in stale])
+        for number, index in zip(stale, fresh_indexes):
+            indexes[number] = index
+            self.margin_cache.put(spread.id, worksheets[number], modified_time, index)
+
+        self.metrics.count('margin_cache_hits', len(worksheets) - len(stale))
+        self.metrics.count('margin_cache_misses', len(stale))
+        print(success_message + f'\tКэш маржи: из кэша {len(worksheets) - len(stale)} страниц, '
+                                f'прочитано из таблицы {len(stale)}')
+        return merge_margin_indexes(indexes)
+
+
+    def shared_margin_index(self, spread):
+
+        """
+        Индекс маржи, общий для заданий с одной таблицей расчетов: первое задание читает таблицу,
+        остальные ждут его результат, а не читают те же страницы второй раз
+        """
+
+        from concurrent.futures import Future
+
+        if self.margin_indexes is None:
+            return self.load_margin_index(spread)
+
+        with self.pool.lock:
+            future = self.margin_indexes.get(spread.id)
+            owner = future is None
+            if owner:
+                future = self.margin_indexes[spread.id] = Future()
+
+        if owner:
+            try:
+                future.set_result(self.load_margin_index(spread))
+            except Exception as error:
+                future.set_exception(error)
+        return future.result()
+
+
+    def build_margin_index(self, worksheets):
+
+        """
+        Читаем каждую страницу таблицы расчетов одним запросом и строим индекс артикул -> (маржа, итог, да/нет).
+        Дальше поиск маржи по любому заказу идет в памяти, без обращений к API.
+        Страницы читаются и разбираются параллельно в пуле из scan_workers потоков. Все потоки берут жетоны
+        из общего TokenBucket клиента, поэтому параллельность не выходит за квоту
+        """
+
+        return merge_margin_indexes(self.scan_worksheets(worksheets))
+
+
+    def scan_worksheets(self, worksheets):
+
+        """
+        Индексы страниц в том же порядке, в котором переданы страницы
+        """
+
+        def scan(worksheet):
+            return index_margin_worksheet(self.read_worksheet(worksheet))
+
+        workers = min(self.scan_workers, len(worksheets), self.client.bucket.capacity)
+        if workers <= 1:
+            return [scan(worksheet) for worksheet in worksheets]
+
+        from concurrent.futures import ThreadPoolExecutor
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(scan, worksheets)) # map сохраняет порядок страниц для merge_margin_indexes
+
+
+    def read_worksheet(self, worksheet):
+
+        """
+        Все значения страницы одним запросом
+        """
+
+        return self.client.call('get_all_values', worksheet.get_all_values)
+
+
+    def write_cells(self, worksheet, cells, on_batch=None):
+
+        """
+        Записываем ячейки (строка, колонка, значение) пачками через batch_update.
+        После каждой успешной пачки вызывается on_batch(пачка), если он передан.
+        Возвращает количество потраченных запросов
+        """
+
+        import gspread
+
+        batch_calls = 0
+        for start in range(0, len(cells), BATCH_UPDATE_SIZE):
+            batch = cells[start:start + BATCH_UPDATE_SIZE]
+            data = [{'range': gspread.utils.rowcol_to_a1(row, col), 'values': [[value]]} for row, col, value in batch]
+            self.client.call('batch_update', worksheet.batch_update, data, value_input_option='USER_ENTERED')
+            batch_calls += 1
+            if on_batch is not None:
+                on_batch(batch)
+
+        return batch_calls
+
+
+    def save_result(self, first_org, day):
+
+        """
+        сохраняем результат для истории
+        """
+
+        self.history.write_margin_orders(str(day), first_org)
 
-        print(success_message + '\tЗаписали файл ' + filename)
-        self.update_statistics_table()
+        print(success_message + f'\tЗаписали в историю {len(first_org)} товаров за {day}')
 
 
-    def update_statistics_table(self):
+    def update_statistics_table(self, days):
 
         """
-        Обновляем информацию о статистике
+        Обновляем информацию о статистике за дни days одного месяца (см. check_statistics_period).
+        Записываются только ячейки, значение которых отличается от текущего в таблице. Перед записью они сохраняются
+        в историю как незаписанные и вычеркиваются оттуда после каждой пачки, так что прерванный запуск
+        дописывает свои ячейки при следующем
         """
 
-        spread = self.auth_spread('1rEGdqDGFzdaSAlTzjiFt-GlW-scgLx2-UDgQdN0PL_s')
-        # spread = self.auth_spread('1J6EJ601kR_S1_sMDFk4ibzMaG5mEgWUMcV1e_jL67Qs')
-        worksheet = spread.get_worksheet(1)
-        orders = []
-        margins = []
+        check_statistics_period(days)
+
+        spread = self.auth_spread(self.statistics_id)
+        worksheet = self.pool.worksheets(spread, self.client)[self.statistics_worksheet]
 
         # ФАЙЛ ПОКА НЕ МОЖЕТ РАБОТАТЬ С ЛИСТАМИ ТАБЛИЦЫ 
         # print(warning_message + '\tБот взял паузу на одну минуту, чтобы избежать лимита на количество запросов в минуту.')
@@ -432,56 +1523,307 @@ class Spreadsheet:
         
         print(warning_message + '\tОбновляем статистику')
 
-        def update_order(order, margin, count, price, share):
-            try:
-                order_row = worksheet.find(order).row + 1
-                order_count_row = order_row - 1
-                order_price_row = order_row + 1  
-                order_share_row = order_price_row + 1
-                tomorrow_col = worksheet.find(tomorrow).col
-
-                data_rows = worksheet.findall(tomorrow)
-                for item in data_rows:
-                    if item.row == order_row-2:
-                        tomorrow_col = item.col
-                        break
-
-                worksheet.update_cell(order_row, tomorrow_col, margin)
-                worksheet.update_cell(order_count_row, tomorrow_col, count)
-                worksheet.update_cell(order_price_row, tomorrow_col, price)
-                worksheet.update_cell(order_share_row, tomorrow_col, share)
-                quit()
-            except gspread.exceptions.APIError:
-                print(warning_message + '\tБот превысил лимит запросов. Автоматически продолжит работу через 20 секунд.')
-                sleep(20)
-                update_order(order, margin, count, price, share)
-            except BaseException as error:
-                print(error)
-
-
-        with open(f'{history_directory}/margin_orders.txt', 'r') as file:
-            for line in file:
-                order = line.split('-')[0].strip()
-                margin = line.split('-')[1].replace('\n', '').strip().replace('.', ',')
-                count = line.split('-')[2].strip()
-                price = line.split('-')[3].strip().replace('.', ',')
-                share = line.split('-')[4].strip().replace('\n', '')
-                
-                update_order(order, margin, count, price, share)
-                
-                
-                
+        statistics_by_day = {
+            str(day.day): {order: (format_number(margin), str(count), format_number(price), share)
+                            for order, (margin, count, price, share) in self.history.read_day_statistics(str(day)).items()}
+            for day in days
+        }
+
+        values = self.read_worksheet(worksheet)
+        cells, missing_orders = plan_statistics_update(values, statistics_by_day)
+        for order in missing_orders:
+            print(warning_message + f'\tВ таблице статистики не нашли товар {order}')
+
+        checkpoint = f'{spread.id}/{worksheet.id}'
+        pending = self.history.read_pending_cells(checkpoint)
+        if pending:
+            print(warning_message + f'\tДописываем {len(pending)} ячеек, оставшихся от прерванного запуска')
+
+        planned = {(row, col): value for row, col, value in pending + cells} # Новый план важнее старого
+        changed = [(row, col, value) for (row, col), value in planned.items() if not cell_matches(values, row, col, value)]
+
+        self.metrics.count('cells_written', len(changed))
+        self.metrics.count('cells_unchanged', len(planned) - len(changed))
+        self.history.save_pending_cells(checkpoint, changed)
+        batch_calls = self.write_cells(worksheet, changed, on_batch=lambda batch: self.history.clear_pending_cells(checkpoint, batch))
+        # Старый путь тратил на каждый товар find, find, findall и четыре update_cell
+        print(success_message + f'\tЗаписали {len(changed)} ячеек из {len(planned)} (остальные уже актуальны) '
+                                f'за {1 + batch_calls} запросов к API '
+                                f'вместо {7 * sum(map(len, statistics_by_day.values()))} при поячеечной записи')
+
         print(success_message + '\tБот успешно завершил свою работу')
 
 
 
+JOBS_FILE = 'jobs.json'
+JOB_SOURCES = ('excel', 'selenium', 'api', 'history')
+
+
+class Job:
+    """
+    Задание на одну организацию (или группу организаций одного аккаунта): откуда брать заказы,
+    в какую таблицу расчетов смотреть за маржой и в какую таблицу статистики писать.
+    name - короткое латинское имя, из него строятся имена файлов истории и метрик задания.
+    organizations - какие организации из выгрузки относятся к заданию, пустой список - все. Организации с общей
+    страницей статистики или общей папкой выгрузок перечисляются в одном задании (см. check_jobs).
+    moysklad - префикс переменных окружения с учетными данными МоегоСклада: MOYSKLAD -> MOYSKLAD_LOGIN и т.д.
+    states - статусы заказов, которые учитывает источник api, пустой список - статусы из {moysklad}_STATES или все.
+    """
+
+    def __init__(self, name, source='excel', organizations=(), folder='Excel', moysklad='MOYSKLAD', states=(),
+                 calculation_id=CALCULATION_SPREAD_ID, statistics_id=STATISTICS_SPREAD_ID,
+                 statistics_worksheet=STATISTICS_WORKSHEET, keyfile=KEYFILE):
+        if source not in JOB_SOURCES:
+            raise ValueError(f'Задание {name}: неизвестный источник заказов {source}, ожидается один из {JOB_SOURCES}')
+        self.name = name
+        self.source = source
+        self.organizations = set(organizations)
+        self.folder = folder
+        self.moysklad = moysklad
+        self.states = tuple(states)
+        self.calculation_id = calculation_id
+        self.statistics_id = statistics_id
+        self.statistics_worksheet = statistics_worksheet
+        self.keyfile = keyfile
+
+
+    def history_file(self):
+        return os.path.join(os.getcwd(), f'history_{self.name}.sqlite3')
+
+
+    def frequency_dictionary(self, day, history, metrics, excel_reader):
+
+        """
+        Частотный словарь заказов задания за день, только по его организациям
+        """
+
+        login, password, token = (os.environ.get(f'{self.moysklad}_{key}') for key in ('LOGIN', 'PASSWORD', 'TOKEN'))
+
+        if self.source == 'api':
+            states = self.states or order_states(os.environ.get(f'{self.moysklad}_STATES'))
+            frequency_dictionary = MoySkladAPI(login, password, token=token, states=states, metrics=metrics).get_frequency_dict(str(day))
+        elif self.source == 'selenium':
+            bot_selenium = SeleniumParser(login, password, history=history, day=day, metrics=metrics)
+            bot_selenium.start()
+            frequency_dictionary = bot_selenium.get_frequency_dict()
+        elif self.source == 'history':
+            frequency_dictionary = count_orders(history.read_orders(str(day)))
+        else:
+            frequency_dictionary = excel_reader.open_excel(self.folder)
+
+        if not self.organizations:
+            return frequency_dictionary
+        return Counter({(organization, order): count for (organization, order), count in frequency_dictionary.items()
+                            if organization in self.organizations})
+
+
+def load_jobs(filename=JOBS_FILE):
+
+    """
+    Читаем задания из JSON: {"jobs": [{"name": "ermalovich", "source": "excel", "folder": "Excel/ermalovich",
+    "organizations": ["ИП Ермалович"], "calculation_id": "...", "statistics_id": "..."}, ...]}.
+    Незаданные поля берутся по умолчанию из Job
+    """
+
+    with open(filename, encoding='utf-8') as file:
+        jobs = [Job(**job) for job in json.load(file)['jobs']]
+
+    check_jobs(jobs)
+    return jobs
+
+
+def check_jobs(jobs):
+
+    """
+    Проверяем, что параллельные задания не мешают друг другу. Заказы одного артикула всех организаций
+    складываются в одну строку таблицы статистики, а выгрузка удаляется после обработки, поэтому
+    организации с общей страницей статистики или общей папкой выгрузок описываются одним заданием
+    (несколько организаций в organizations), а не несколькими
+    """
+
+    names = [job.name for job in jobs]
+    if len(set(names)) != len(names):
+        raise ValueError('Имена заданий должны быть уникальными: по ним разделяются файлы истории')
+
+    shared = {
+        'страницу статистики': Counter((job.statistics_id, job.statistics_worksheet) for job in jobs),
+        'папку выгрузок': Counter(os.path.abspath(job.folder) for job in jobs if job.source == 'excel'),
+    }
+    for what, usage in shared.items():
+        for key, amount in usage.items():
+            if amount > 1:
+                raise ValueError(f'{amount} задания используют одну {what} {key}: объедините их организации в одно задание')
+
+
+def run_job(job, day, pool, margin_cache, refresh_margins, margin_indexes):
+
+    """
+    Одно задание целиком: сбор заказов, маржа, запись статистики. У задания своя история и свои метрики,
+    а пул подключений, SheetsClient с его квотой и индексы маржи общие на все задания
+    """
+
+    os.makedirs(history_directory(day), exist_ok=True)
+    metrics = RunMetrics()
+    history = HistoryStore(job.history_file())
+    spread = Spreadsheet(pool=pool, margin_cache=margin_cache, refresh_margins=refresh_margins, history=history,
+                         metrics=metrics, calculation_id=job.calculation_id, statistics_id=job.statistics_id,
+                         statistics_worksheet=job.statistics_worksheet, keyfile=job.keyfile, margin_indexes=margin_indexes)
+    try:
+        with metrics.phase('total'):
+            with metrics.phase('orders'):
+                excel_reader = ExcelReader(metrics=metrics)
+                frequency_dictionary = job.frequency_dictionary(day, history, metrics, excel_reader)
+            if job.source in ('excel', 'api'):
+                history.write_orders(str(day), frequency_dictionary.elements())
+            spread.run(frequency_dictionary, day)
+            excel_reader.remove_processed()
+    finally:
+        metrics.write_json(os.path.join(history_directory(day), f'metrics_{job.name}.json'))
+    return metrics
+
+
+def run_jobs(jobs, day=None, workers=None, pool=None, margin_cache=None, refresh_margins=False, metrics=None):
+
+    """
+    Выполняем задания параллельно, по потоку на задание (не больше workers). Все потоки ходят в Google
+    через один SheetsClient пула, поэтому квота запросов общая и параллельные задания ее не превышают,
+    а время всего запуска приближается к времени самого долгого задания, а не к сумме.
+    Упавшее задание не останавливает остальные. Возвращает словарь имя задания -> ошибка или None
+    """
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    check_jobs(jobs)
+    day = day or yesterday()
+    pool = pool or client_pool
+    metrics = metrics or RunMetrics()
+    margin_indexes = {}
+
+    def timed_job(job):
+        with metrics.phase(f'job_{job.name}'):
+            return run_job(job, day, pool, margin_cache, refresh_margins, margin_indexes)
+
+    errors = {}
+    with ThreadPoolExecutor(max_workers=workers or len(jobs) or 1) as executor:
+        futures = {job.name: executor.submit(timed_job, job) for job in jobs}
+        for name, future in futures.items():
+            try:
+                future.result()
+                errors[name] = None
+            except Exception as error:
+                errors[name] = error
+                print(warning_message + f'\tЗадание {name} завершилось с ошибкой: {error!r}')
+
+    done = sum(error is None for error in errors.values())
+    print(success_message + f'\tЗаданий выполнено {done} из {len(errors)}. Время по заданиям: ' + metrics.report())
+    return errors
+
+
+
 # parse_method = int(input('Каким образом вы хотите спарсить данные?\n1. Selenuim\n2. Excel-файл\nУкажите номер варианта: '))
 
 
-bot_excel = ExcelReader()
-frequen_dict = bot_excel.open_excel()
-spread = Spreadsheet()
-spread.run(frequen_dict)
+METRICS_FILE = 'metrics.json'
+
+
+def main(argv=None):
+
+    """
+    Точка входа: python bot.py excel | selenium | api | backfill START END | jobs [CONFIG].
+    При импорте модуля ничего не выполняется, вся работа начинается здесь
+    """
+
+    import argparse
+
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--refresh-margins', action='store_true', help='перечитать таблицу расчетов целиком, не используя кэш маржи')
+    common.add_argument('--prometheus', metavar='FILE', help='дополнительно выгрузить метрики запуска в textfile для Prometheus')
+    states = argparse.ArgumentParser(add_help=False)
+    states.add_argument('--state', action='append', dest='states', metavar='NAME',
+                        help='учитывать только заказы API МоегоСклада с этим статусом, можно указать несколько раз. '
+                             'По умолчанию статусы через запятую из MOYSKLAD_STATES, без нее - все заказы')
+
+    parser = argparse.ArgumentParser(description='Бот статистики заказов')
+    commands = parser.add_subparsers(dest='command', required=True)
+    excel = commands.add_parser('excel', parents=[common], help='заказы из выгрузок в папке Excel')
+    excel.add_argument('--folder', default='Excel', help='папка с выгрузками .xls/.xlsx')
+    commands.add_parser('selenium', parents=[common], help='заказы с сайта МоегоСклада через браузер')
+    commands.add_parser('api', parents=[common, states], help='заказы из API МоегоСклада')
+    backfill = commands.add_parser('backfill', parents=[common, states], help='досчитать статистику за период')
+    backfill.add_argument('start', type=datetime.date.fromisoformat, help='первый день, YYYY-MM-DD')
+    backfill.add_argument('end', type=datetime.date.fromisoformat, help='последний день, YYYY-MM-DD')
+    backfill.add_argument('--source', choices=('api', 'history'), default='history',
+                          help='откуда брать заказы за дни периода: API МоегоСклада или история бота')
+    jobs = commands.add_parser('jobs', parents=[common], help='параллельно выполнить задания по организациям из файла')
+    jobs.add_argument('config', nargs='?', default=JOBS_FILE, help='JSON со списком заданий (см. load_jobs)')
+    jobs.add_argument('--workers', type=int, help='сколько заданий выполнять одновременно, по умолчанию все')
+    args = parser.parse_args(argv)
+
+    enable_console_colors()
+    os.makedirs(history_directory(yesterday()), exist_ok=True) # Создаем директории истории за текущий день, если она не была создана 
+
+    metrics = RunMetrics()
+    history = HistoryStore()
+    spread = Spreadsheet(margin_cache=MarginCache(), refresh_margins=args.refresh_margins, history=history, metrics=metrics)
+    try:
+        with metrics.phase('total'):
+            run_command(args, spread, history, metrics)
+    except NoExportsError as error:
+        print(warning_message + f'\t{error}')
+    finally:
+        # Метрики пишем и после упавшего запуска, чтобы было видно, на каком этапе ушло время
+        metrics.write_json(os.path.join(history_directory(yesterday()), METRICS_FILE), spread.client)
+        if args.prometheus:
+            metrics.write_prometheus(args.prometheus, spread.client)
+
+
+def run_command(args, spread, history, metrics):
+
+    """
+    Выполняем выбранную подкоманду
+    """
+
+    # Учетные данные МоегоСклада берутся из переменных окружения
+    login, password, token = os.environ.get('MOYSKLAD_LOGIN'), os.environ.get('MOYSKLAD_PASSWORD'), os.environ.get('MOYSKLAD_TOKEN')
+    states = getattr(args, 'states', None) or order_states(os.environ.get('MOYSKLAD_STATES'))
+
+    if args.command == 'jobs':
+        run_jobs(load_jobs(args.config), workers=args.workers, pool=spread.pool, margin_cache=spread.margin_cache,
+                 refresh_margins=args.refresh_margins, metrics=metrics)
+        return
+
+    if args.command == 'backfill':
+        days = date_range(args.start, args.end)
+        check_statistics_period(days) # До загрузки заказов, а не после расчета маржи
+        if args.source == 'api':
+            api = MoySkladAPI(login, password, token=token, states=states, metrics=metrics)
+            frequency_by_day = {day: api.get_frequency_dict(str(day)) for day in days}
+            for day, frequency_dictionary in frequency_by_day.items():
+                history.write_orders(str(day), frequency_dictionary.elements())
+        else:
+            frequency_by_day = {day: count_orders(history.read_orders(str(day))) for day in days}
+        spread.backfill(frequency_by_day)
+        return
+
+    if args.command == 'api':
+        frequen_dict = MoySkladAPI(login, password, token=token, states=states, metrics=metrics).get_frequency_dict()
+    elif args.command == 'selenium':
+        bot_selenium = SeleniumParser(login, password, history=history, metrics=metrics)
+        bot_selenium.start()
+        frequen_dict = bot_selenium.get_frequency_dict()
+    else:
+        bot_excel = ExcelReader(metrics=metrics)
+        frequen_dict = bot_excel.open_excel(args.folder)
+    if args.command != 'selenium':
+        # SeleniumParser пишет заказы в историю сам, заказы из Excel и API сохраняем здесь, чтобы их можно было пересчитать через backfill
+        history.write_orders(str(yesterday()), frequen_dict.elements())
+    spread.run(frequen_dict)
+    if args.command == 'excel':
+        bot_excel.remove_processed()
+
+
+if __name__ == '__main__':
+    main()
 
 
 # ex = ExcelReader('/home/saloman/Downloads/02.01.xls')
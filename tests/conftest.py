@@ -0,0 +1,36 @@
+import os
+import sys
+
+import pytest
+
+# bot.py и benchmark.py лежат в корне репозитория
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def make_pool():
+
+    """
+    Пул с уже открытыми фейковыми таблицами и клиентом без ощутимого лимита запросов
+    """
+
+    from bot import SheetsClient, TokenBucket
+    from fakes import fake_pool
+
+    def make(*spreads):
+        client = SheetsClient(bucket=TokenBucket(rate=10_000, period=1.0))
+        return fake_pool(client, *spreads)
+    return make
+
+
+@pytest.fixture
+def count_cell():
+
+    """
+    Значение ячейки количества товара article в колонке дня day на странице статистики
+    """
+
+    def cell(worksheet, article, day):
+        row = next(number for number, values in enumerate(worksheet.values) if values[0] == article)
+        return worksheet.values[row][worksheet.values[row - 1].index(str(day.day))]
+    return cell
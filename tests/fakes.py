@@ -0,0 +1,364 @@
+"""
+Фейки и генераторы синтетических данных для тестов и бенчмарков: фейковый бэкенд Google Sheets
+(FakeBackend, FakeSpreadsheet, FakeWorksheet) с настраиваемой задержкой, ошибками и квотой, пул с уже открытыми
+таблицами, выгрузки МоегоСклада в Excel и локальный HTTP-сервер с API МоегоСклада.
+gspread импортируется лениво, только когда фейку нужны его классы
+"""
+
+import datetime
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+from collections import Counter, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+from time import perf_counter, sleep
+
+from bot import ClientPool, KEYFILE, SCOPE, CALCULATION_SPREAD_ID, STATISTICS_SPREAD_ID
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__))) # Корень репозитория, где лежит bot.py
+
+
+ORGANIZATIONS = ['ИП Ермалович', 'ИП Александров']
+
+
+def generate_rows(amount, articles=5000, seed=0):
+
+    """
+    Синтетические строки выгрузки: пары (организация, артикул)
+    """
+
+    rnd = random.Random(seed)
+    return [(rnd.choice(ORGANIZATIONS), f'ART-{rnd.randrange(articles)}') for _ in range(amount)]
+
+
+def write_excel_export(path, rows):
+
+    """
+    Синтетическая выгрузка МоегоСклада: организация в третьей колонке, комментарий с артикулом в пятой.
+    .xls пишется через xlwt, .xlsx - через openpyxl
+    """
+
+    header = ['№', 'Время', 'Организация', 'Статус', 'Комментарий', 'Сумма']
+    lines = [header] + [[number, '10:00', organization, 'Новый', f'{order}, доставка', 1000]
+                            for number, (organization, order) in enumerate(rows, start=1)]
+
+    if path.endswith('.xlsx'):
+        from openpyxl import Workbook
+
+        workbook = Workbook(write_only=True)
+        worksheet = workbook.create_sheet()
+        for line in lines:
+            worksheet.append(line)
+        workbook.save(path)
+        return
+
+    import xlwt
+
+    workbook = xlwt.Workbook()
+    worksheet = workbook.add_sheet('Заказы')
+    for row, line in enumerate(lines):
+        for col, value in enumerate(line):
+            worksheet.write(row, col, value)
+    workbook.save(path)
+
+
+def serve_moysklad(orders, listed_organizations=None):
+
+    """
+    Локальный HTTP-сервер в формате API МоегоСклада: заказы страницами из /entity/customerorder,
+    список организаций из /entity/organization и организация по своему href.
+    Как и настоящий API, организацию в заказе разворачивает (expand) только при limit <= 100,
+    иначе отдает одну ссылку meta. listed_organizations - какие организации попадают в список, None - все.
+    Запросы (путь и параметры) складываются в server.requests. Возвращает сервер, запущенный в фоновом потоке
+    """
+
+    names = sorted({organization for organization, order in orders})
+    listed = names if listed_organizations is None else listed_organizations
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def organization(self, name, expand=False):
+            href = f'http://127.0.0.1:{self.server.server_port}/entity/organization/{names.index(name)}'
+            meta = {'href': href, 'type': 'organization'}
+            return {'meta': meta, 'name': name} if expand else {'meta': meta}
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            query = parse_qs(url.query)
+            self.server.requests.append((url.path, query, self.headers.get('Authorization')))
+
+            if url.path.startswith('/entity/organization/'):
+                page = self.organization(names[int(url.path.rsplit('/', 1)[1])], expand=True)
+            else:
+                offset, limit = int(query['offset'][0]), int(query['limit'][0])
+                if url.path == '/entity/organization':
+                    size, rows = len(listed), [self.organization(name, expand=True) for name in listed[offset:offset + limit]]
+                else:
+                    expand = 'organization' in query.get('expand', []) and limit <= 100
+                    size, rows = len(orders), [{'organization': self.organization(organization, expand), 'description': f'{order}, доставка'}
+                                                    for organization, order in orders[offset:offset + limit]]
+                page = {'meta': {'size': size, 'limit': limit, 'offset': offset}, 'rows': rows}
+            body = json.dumps(page, ensure_ascii=False).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    Handler.protocol_version = 'HTTP/1.1' # keep-alive, чтобы сессия переиспользовала соединение
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.requests = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+IMPORT_TIME_BUDGET = 0.1 # Секунды на import bot без тяжелых зависимостей
+HEAVY_MODULES = ('selenium', 'pandas', 'numpy', 'gspread', 'oauth2client', 'xlrd', 'requests')
+
+
+def import_time(statement):
+
+    """
+    Суммарное время импорта верхнего уровня по python -X importtime, в секундах
+    """
+
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', statement],
+                            capture_output=True, text=True, check=True, cwd=ROOT)
+    total = 0
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        if not name.startswith('  ') and name.strip() not in ('site', 'encodings'):
+            total += int(cumulative_us)
+    return total / 1_000_000
+
+
+class FakeResponse:
+    """
+    Минимальный ответ requests, из которого gspread собирает APIError
+    """
+
+    def __init__(self, code, message):
+        self.code = code
+        self.text = message
+
+    def json(self):
+        return {'error': {'code': self.code, 'message': self.text, 'status': 'FAKE'}}
+
+
+class FakeBackend:
+    """
+    Локальная замена Google Sheets, общая для всех фейковых таблиц и страниц.
+    Каждый запрос ждет latency секунд, с вероятностью error_rate отвечает ошибкой квоты (429)
+    и отвечает ей же, если за последние window секунд было больше quota запросов.
+    Считает запросы по методам
+    """
+
+    def __init__(self, error_rate=0.0, latency=0.0, quota=None, window=60.0, seed=0):
+        self.error_rate = error_rate
+        self.latency = latency
+        self.quota = quota
+        self.window = window
+        self.random = random.Random(seed)
+        self.recent = deque()
+        self.calls = Counter()
+        self.requests = 0
+        self.errors = 0
+        self.lock = threading.Lock()
+
+    def request(self, method='request'):
+        sleep(self.latency)
+        with self.lock:
+            self.requests += 1
+            self.calls[method] += 1
+
+            now = perf_counter()
+            while self.recent and now - self.recent[0] > self.window:
+                self.recent.popleft()
+            over_quota = self.quota is not None and len(self.recent) >= self.quota
+            if not over_quota:
+                self.recent.append(now)
+
+            if over_quota or self.random.random() < self.error_rate:
+                import gspread
+
+                self.errors += 1
+                raise gspread.exceptions.APIError(FakeResponse(429, 'Quota exceeded'))
+
+
+class FakeWorksheet:
+    """
+    Страница таблицы с той частью интерфейса gspread.Worksheet, которой пользуется бот
+    """
+
+    def __init__(self, backend, title, values, sheet_id=0):
+        self.backend = backend
+        self.id = sheet_id
+        self.title = title
+        self.values = values
+
+    @property
+    def row_count(self):
+        return len(self.values)
+
+    @property
+    def col_count(self):
+        return max((len(row) for row in self.values), default=0)
+
+    def _cells(self, query):
+        import gspread
+
+        for row_number, row in enumerate(self.values, start=1):
+            for col_number, value in enumerate(row, start=1):
+                if value == query:
+                    yield gspread.cell.Cell(row_number, col_number, value)
+
+    def _set(self, row, col, value):
+        while len(self.values) < row:
+            self.values.append([])
+        line = self.values[row - 1]
+        line.extend([''] * (col - len(line)))
+        line[col - 1] = str(value)
+
+    def find(self, query):
+        self.backend.request('find')
+        return next(self._cells(str(query)), None)
+
+    def findall(self, query):
+        self.backend.request('findall')
+        return list(self._cells(str(query)))
+
+    def cell(self, row, col):
+        import gspread
+
+        self.backend.request('cell')
+        line = self.values[row - 1] if row <= len(self.values) else []
+        return gspread.cell.Cell(row, col, line[col - 1] if col <= len(line) else None)
+
+    def update_cell(self, row, col, value):
+        self.backend.request('update_cell')
+        self._set(row, col, value)
+
+    def get_all_values(self):
+        self.backend.request('get_all_values')
+        return [list(row) for row in self.values]
+
+    def batch_get(self, ranges):
+        import gspread
+
+        self.backend.request('batch_get')
+        result = []
+        for a1_range in ranges:
+            start, _, end = a1_range.partition(':')
+            first_row, first_col = gspread.utils.a1_to_rowcol(start)
+            last_row, last_col = gspread.utils.a1_to_rowcol(end or start)
+            result.append([[line[col - 1] if col <= len(line) else '' for col in range(first_col, last_col + 1)]
+                                for line in self.values[first_row - 1:last_row]])
+        return result
+
+    def batch_update(self, data, value_input_option=None):
+        import gspread
+
+        self.backend.request('batch_update')
+        for item in data:
+            row, col = gspread.utils.a1_to_rowcol(item['range'])
+            self._set(row, col, item['values'][0][0])
+
+
+class FakeSpreadsheet:
+    """
+    Таблица с той частью интерфейса gspread.Spreadsheet, которой пользуется бот
+    """
+
+    def __init__(self, backend, worksheets, spread_id='fake', modified_time='2022-01-01T00:00:00.000Z'):
+        self.backend = backend
+        self.id = spread_id
+        self.modified_time = modified_time
+        self._worksheets = worksheets
+
+    def get_lastUpdateTime(self):
+        self.backend.request('get_lastUpdateTime')
+        return self.modified_time
+
+    def worksheets(self):
+        self.backend.request('worksheets')
+        return list(self._worksheets)
+
+    def get_worksheet(self, index):
+        self.backend.request('get_worksheet')
+        return self._worksheets[index]
+
+
+class FakeCredentials:
+    """
+    Учетные данные google-auth, которые gspread хранит в gc.http_client.auth
+    """
+
+    def __init__(self, expiry=None):
+        self.expiry = expiry
+        self.refreshed = 0
+
+    def refresh(self, request):
+        self.refreshed += 1
+        self.expiry = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+
+
+class FakeGspreadClient:
+    def __init__(self, credentials=None):
+        self.http_client = type('HTTPClient', (), {})()
+        self.http_client.auth = credentials or FakeCredentials()
+
+
+def fake_pool(client, *spreads):
+
+    """
+    ClientPool, в котором таблицы уже "открыты", так что бот не ходит за ключом и в сеть
+    """
+
+    pool = ClientPool(client)
+    pool.clients[(KEYFILE, SCOPE)] = FakeGspreadClient()
+    for spread in spreads:
+        pool.spreads[(KEYFILE, spread.id)] = spread
+    return pool
+
+
+def generate_calculation_sheet(backend, sheets=12, articles=300, spread_id=CALCULATION_SPREAD_ID):
+
+    """
+    Синтетическая таблица расчетов: страница на группу товаров, у каждой строка заголовков и строки товаров
+    """
+
+    worksheets = []
+    for number in range(sheets):
+        values = [['Артикул', 'Наименование', 'Маржа', 'Итог (клиент)', 'да/нет']]
+        for article in range(number * articles, (number + 1) * articles):
+            values.append([f'ART-{article}', f'Товар {article}', f'{article % 900 + 100},50 ₽', f'{article % 900 + 500} ₽', 'да'])
+        worksheets.append(FakeWorksheet(backend, f'Группа {number}', values, sheet_id=number))
+
+    return FakeSpreadsheet(backend, worksheets, spread_id=spread_id)
+
+
+def generate_statistics_sheet(backend, articles, spread_id=STATISTICS_SPREAD_ID):
+
+    """
+    Синтетическая таблица статистики за месяц: на каждый товар блок из строки чисел месяца,
+    строки артикула (количество) и строк маржи, итога и да/нет. Статистика лежит на второй странице, как в боевой таблице
+    """
+
+    values = []
+    for article in range(articles):
+        values.append([''] + [str(day) for day in range(1, 32)])
+        values.append([f'ART-{article}'] + [''] * 31)
+        values.extend([['Маржа'] + [''] * 31, ['Итог'] + [''] * 31, ['да/нет'] + [''] * 31])
+
+    worksheets = [FakeWorksheet(backend, 'Сводка', [['Сводка']], sheet_id=0), FakeWorksheet(backend, 'Статистика', values, sheet_id=1)]
+    return FakeSpreadsheet(backend, worksheets, spread_id=spread_id)
@@ -0,0 +1,48 @@
+import subprocess
+import sys
+
+import pytest
+
+import bot
+from fakes import HEAVY_MODULES, IMPORT_TIME_BUDGET, ROOT, import_time, write_excel_export
+
+
+def run_python(code, cwd):
+    return subprocess.run([sys.executable, '-c', f'import sys; sys.path.insert(0, {ROOT!r}); ' + code],
+                          capture_output=True, text=True, check=True, cwd=cwd).stdout
+
+
+def test_import_loads_no_heavy_dependencies(tmp_path):
+    loaded = run_python('import bot; print(" ".join(sorted(sys.modules)))', tmp_path).split()
+    assert [module for module in HEAVY_MODULES if module in loaded] == []
+
+
+def test_import_time_budget():
+    assert import_time('import bot') < IMPORT_TIME_BUDGET
+
+
+def test_import_has_no_side_effects(tmp_path):
+    run_python('import bot', tmp_path)
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_excel_path_does_not_load_selenium(tmp_path):
+    write_excel_export(str(tmp_path / 'orders.xls'), [('ИП А', 'ART-1')])
+    loaded = run_python(f'import bot; bot.ExcelReader().open_excel({str(tmp_path)!r}); print(" ".join(sorted(sys.modules)))',
+                        tmp_path).split()
+    assert 'selenium' not in loaded and 'pandas' not in loaded
+
+
+@pytest.mark.parametrize('argv', [[], ['unknown'], ['backfill', '2022-01-10']])
+def test_bad_command_line_exits_with_usage_error(argv):
+    with pytest.raises(SystemExit) as error:
+        bot.main(argv)
+    assert error.value.code == 2
+
+
+@pytest.mark.parametrize('command', ['excel', 'selenium', 'api', 'backfill', 'jobs'])
+def test_subcommands_have_help(command, capsys):
+    with pytest.raises(SystemExit) as error:
+        bot.main([command, '--help'])
+    assert error.value.code == 0
+    assert '--prometheus' in capsys.readouterr().out
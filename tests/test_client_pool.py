@@ -0,0 +1,92 @@
+import datetime
+import json
+import threading
+import time
+
+import pytest
+
+from fakes import FakeBackend, FakeGspreadClient, FakeSpreadsheet, FakeWorksheet
+from bot import ClientPool, SheetsClient, TokenBucket, KEYFILE, SCOPE
+
+
+@pytest.fixture
+def keyfile(tmp_path):
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    pem = key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption())
+    path = tmp_path / 'key.json'
+    path.write_text(json.dumps({
+        'type': 'service_account', 'project_id': 'test', 'private_key_id': '1', 'private_key': pem.decode(),
+        'client_email': 'bot@test.iam.gserviceaccount.com', 'client_id': '1', 'token_uri': 'https://oauth2.googleapis.com/token',
+    }))
+    return str(path)
+
+
+def test_token_is_refreshed_on_the_credentials_gspread_uses(keyfile):
+    pool = ClientPool()
+    gc = pool.authorize(keyfile)
+    credentials = gc.http_client.auth
+    refreshed = []
+    credentials.refresh = refreshed.append
+
+    credentials.expiry = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+    assert pool.authorize(keyfile) is gc
+    assert refreshed == []
+
+    credentials.expiry = datetime.datetime.utcnow() + datetime.timedelta(minutes=1)
+    assert pool.authorize(keyfile) is gc
+    assert len(refreshed) == 1
+
+
+class SlowClient:
+    def __init__(self, spreads, delay):
+        self.spreads = spreads
+        self.delay = delay
+        self.opened = []
+
+    def open_by_key(self, spread_id):
+        self.opened.append(spread_id)
+        time.sleep(self.delay)
+        return self.spreads[spread_id]
+
+
+def test_open_does_not_block_other_spreadsheets():
+    backend = FakeBackend()
+    spreads = {name: FakeSpreadsheet(backend, [FakeWorksheet(backend, 'a', [])], spread_id=name) for name in 'abcd'}
+    pool = ClientPool(SheetsClient(bucket=TokenBucket(rate=1000, period=1.0)))
+    pool.clients[(KEYFILE, SCOPE)] = FakeGspreadClient()
+    pool.clients[(KEYFILE, SCOPE)].open_by_key = SlowClient(spreads, delay=0.2).open_by_key
+    opened = {}
+
+    def open_spread(name):
+        opened[name] = pool.open(name)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=open_spread, args=(name,)) for name in 'abcdabcd']
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert time.perf_counter() - start < 0.6
+    assert opened == spreads
+    assert pool.client.stats()['calls_by_type'] == {'open_by_key': 4} # Повторные открытия ждут первое, а не ходят в API
+
+
+def test_failed_open_is_retried_by_next_call():
+    pool = ClientPool(SheetsClient(bucket=TokenBucket(rate=1000, period=1.0)))
+    pool.clients[(KEYFILE, SCOPE)] = FakeGspreadClient()
+    answers = iter([RuntimeError('network'), 'spread'])
+
+    def open_by_key(spread_id):
+        answer = next(answers)
+        if isinstance(answer, Exception):
+            raise answer
+        return answer
+
+    pool.clients[(KEYFILE, SCOPE)].open_by_key = open_by_key
+    with pytest.raises(RuntimeError):
+        pool.open('a')
+    assert pool.open('a') == 'spread'
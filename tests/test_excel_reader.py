@@ -0,0 +1,27 @@
+import pytest
+
+from fakes import write_excel_export
+from bot import ExcelReader
+
+
+def test_exports_are_kept_until_removed_explicitly(tmp_path):
+    write_excel_export(str(tmp_path / '1.xls'), [('ИП А', 'ART-1'), ('ИП А', 'ART-1')])
+    write_excel_export(str(tmp_path / '2.xlsx'), [('ИП Б', 'ART-1')])
+
+    reader = ExcelReader()
+    frequency_dictionary = reader.open_excel(str(tmp_path))
+    assert frequency_dictionary[('ИП А', 'ART-1')] == 2
+    assert frequency_dictionary[('ИП Б', 'ART-1')] == 1
+    assert sorted(path.name for path in tmp_path.iterdir()) == ['1.xls', '2.xlsx']
+
+    reader.remove_processed()
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_broken_export_does_not_lose_earlier_files(tmp_path):
+    write_excel_export(str(tmp_path / '1.xls'), [('ИП А', 'ART-1')])
+    (tmp_path / '2.xls').write_bytes(b'not an excel file')
+
+    with pytest.raises(Exception):
+        ExcelReader().open_excel(str(tmp_path))
+    assert sorted(path.name for path in tmp_path.iterdir()) == ['1.xls', '2.xls']
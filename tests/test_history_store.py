@@ -0,0 +1,22 @@
+from bot import HistoryStore, SeleniumParser, Spreadsheet
+
+
+def test_write_orders_replaces_the_day(tmp_path):
+    history = HistoryStore(str(tmp_path / 'history.sqlite3'))
+    history.write_orders('2022-01-15', [('ИП А', 'ART-1'), ('ИП А', 'ART-2')])
+    history.write_orders('2022-01-16', [('ИП Б', 'ART-3')])
+
+    history.write_orders('2022-01-15', [('ИП А', 'ART-1')])
+    assert list(history.read_orders('2022-01-15')) == [('ИП А', 'ART-1')]
+    assert list(history.read_orders('2022-01-16')) == [('ИП Б', 'ART-3')]
+
+
+def test_default_store_creates_no_file_until_used(tmp_path, monkeypatch, make_pool):
+    monkeypatch.chdir(tmp_path)
+    Spreadsheet(pool=make_pool())
+    SeleniumParser(None, None)
+    assert list(tmp_path.iterdir()) == []
+
+    history = HistoryStore()
+    assert list(history.read_orders('2022-01-15')) == []
+    assert [path.name for path in tmp_path.iterdir()] == ['history.sqlite3']
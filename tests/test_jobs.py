@@ -0,0 +1,80 @@
+import datetime
+import json
+
+import pytest
+
+from fakes import FakeBackend, generate_calculation_sheet, generate_statistics_sheet, write_excel_export
+from bot import HistoryStore, Job, NoExportsError, load_jobs, run_jobs
+
+
+DAY = datetime.date(2022, 1, 15)
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path) # История и метрики заданий пишутся в текущую директорию
+    return tmp_path
+
+
+def test_load_jobs(workdir):
+    (workdir / 'jobs.json').write_text(json.dumps({'jobs': [
+        {'name': 'ermalovich', 'folder': 'Excel/ermalovich', 'organizations': ['ИП Ермалович'], 'statistics_id': 'a'},
+        {'name': 'alexandrov', 'source': 'api', 'moysklad': 'MOYSKLAD_ALEXANDROV', 'statistics_id': 'b'},
+    ]}), encoding='utf-8')
+
+    ermalovich, alexandrov = load_jobs(str(workdir / 'jobs.json'))
+    assert (ermalovich.source, ermalovich.organizations, ermalovich.statistics_id) == ('excel', {'ИП Ермалович'}, 'a')
+    assert (alexandrov.source, alexandrov.moysklad) == ('api', 'MOYSKLAD_ALEXANDROV')
+
+
+@pytest.mark.parametrize('jobs', [
+    [Job('a', statistics_id='1'), Job('a', statistics_id='2')],
+    [Job('a', folder='Excel', statistics_id='1'), Job('b', folder='Excel/', statistics_id='2')],
+    [Job('a', source='history', statistics_id='1'), Job('b', source='history', statistics_id='1')],
+])
+def test_jobs_sharing_names_folders_or_statistics_sheets_are_rejected(jobs):
+    with pytest.raises(ValueError):
+        run_jobs(jobs)
+
+
+def test_organizations_sharing_a_sheet_are_summed_in_one_job(workdir, make_pool, count_cell):
+    backend = FakeBackend()
+    calculation = generate_calculation_sheet(backend, sheets=1, articles=5)
+    statistics = generate_statistics_sheet(backend, articles=5)
+    job = Job('shared', source='history', organizations=['ИП А', 'ИП Б'])
+    HistoryStore(job.history_file()).write_orders(str(DAY), [('ИП А', 'ART-1')] * 2 + [('ИП Б', 'ART-1')] * 3 + [('ИП В', 'ART-1')])
+
+    assert run_jobs([job], day=DAY, pool=make_pool(calculation, statistics)) == {'shared': None}
+    assert count_cell(statistics._worksheets[1], 'ART-1', DAY) == '5'
+
+
+def test_failed_job_does_not_stop_the_others(workdir, make_pool, count_cell):
+    backend = FakeBackend()
+    calculation = generate_calculation_sheet(backend, sheets=2, articles=5)
+    first, second = generate_statistics_sheet(backend, 10, spread_id='first'), generate_statistics_sheet(backend, 10, spread_id='second')
+    (workdir / 'empty').mkdir()
+    (workdir / 'orders').mkdir()
+    write_excel_export(str(workdir / 'orders' / 'orders.xls'), [('ИП А', 'ART-3')])
+    jobs = [Job('empty', folder='empty', statistics_id='first'), Job('orders', folder='orders', statistics_id='second')]
+
+    errors = run_jobs(jobs, day=DAY, pool=make_pool(calculation, first, second))
+
+    assert isinstance(errors['empty'], NoExportsError)
+    assert errors['orders'] is None
+    assert count_cell(second._worksheets[1], 'ART-3', DAY) == '1'
+    assert list((workdir / 'orders').iterdir()) == []
+    assert ('ИП А', 'ART-3') in HistoryStore(jobs[1].history_file()).read_orders(str(DAY))
+
+
+def test_jobs_with_one_calculation_sheet_read_it_once(workdir, make_pool):
+    backend = FakeBackend(latency=0.01)
+    calculation = generate_calculation_sheet(backend, sheets=4, articles=5)
+    spreads = [generate_statistics_sheet(backend, 20, spread_id=f'statistics{number}') for number in range(3)]
+    jobs = []
+    for number in range(3):
+        job = Job(f'org{number}', source='history', statistics_id=f'statistics{number}')
+        HistoryStore(job.history_file()).write_orders(str(DAY), [('ИП А', f'ART-{number}')])
+        jobs.append(job)
+
+    assert not any(run_jobs(jobs, day=DAY, pool=make_pool(calculation, *spreads)).values())
+    assert backend.calls['get_all_values'] == 4 + 3 # Страницы таблицы расчетов один раз и по странице статистики на задание
@@ -0,0 +1,61 @@
+import pytest
+
+from fakes import FakeBackend, generate_calculation_sheet
+from bot import HistoryStore, MarginCache, RunMetrics, Spreadsheet
+
+
+@pytest.fixture
+def calculation():
+    return generate_calculation_sheet(FakeBackend(), sheets=3, articles=5)
+
+
+@pytest.fixture
+def load(tmp_path, make_pool, calculation):
+    cache = MarginCache(str(tmp_path / 'margin_cache.sqlite3'))
+    pool = make_pool(calculation)
+
+    def load_index(refresh_margins=False):
+        metrics = RunMetrics()
+        spread = Spreadsheet(pool=pool, margin_cache=cache, refresh_margins=refresh_margins,
+                             history=HistoryStore(str(tmp_path / 'history.sqlite3')), metrics=metrics)
+        return spread.load_margin_index(calculation), metrics.rows
+    return load_index
+
+
+def reads(calculation):
+    return calculation.backend.calls['get_all_values']
+
+
+def test_cached_tabs_are_not_read_again(load, calculation):
+    first, counts = load()
+    assert reads(calculation) == 3
+    assert (counts['margin_cache_hits'], counts['margin_cache_misses']) == (0, 3)
+
+    second, counts = load()
+    assert second == first
+    assert reads(calculation) == 3
+    assert (counts['margin_cache_hits'], counts['margin_cache_misses']) == (3, 0)
+
+
+def test_changed_file_invalidates_every_tab(load, calculation):
+    load()
+    calculation.modified_time = '2022-01-02T00:00:00.000Z'
+    load()
+    assert reads(calculation) == 6
+
+
+def test_resized_tab_is_read_again(load, calculation):
+    load()
+    worksheet = calculation._worksheets[1]
+    worksheet.values.append(['ART-NEW', 'Новый товар', '10,00 ₽', '20 ₽', 'да'])
+
+    index, counts = load()
+    assert reads(calculation) == 4
+    assert (counts['margin_cache_hits'], counts['margin_cache_misses']) == (2, 1)
+    assert 'ART-NEW' in index
+
+
+def test_refresh_margins_skips_the_cache(load, calculation):
+    load()
+    load(refresh_margins=True)
+    assert reads(calculation) == 6
@@ -0,0 +1,108 @@
+import datetime
+
+import pytest
+
+import bot
+from fakes import generate_rows, serve_moysklad
+from bot import Job, MoySkladAPI, RunMetrics, count_orders, MOYSKLAD_PAGE_LIMIT
+
+
+@pytest.fixture
+def serve():
+    servers = []
+
+    def start(rows, **kwargs):
+        servers.append(serve_moysklad(rows, **kwargs))
+        return servers[-1]
+
+    yield start
+    for server in servers:
+        server.shutdown()
+
+
+def api_for(server, **kwargs):
+    return MoySkladAPI(base_url=f'http://127.0.0.1:{server.server_port}', **kwargs)
+
+
+def test_orders_of_all_pages_are_counted(serve):
+    rows = generate_rows(2 * MOYSKLAD_PAGE_LIMIT + 10, articles=50)
+    server = serve(rows)
+
+    assert api_for(server, token='fake').get_frequency_dict('2022-01-15') == count_orders(rows)
+    paths = [path for path, query, auth in server.requests]
+    assert paths.count('/entity/customerorder') == 3
+    assert paths.count('/entity/organization') == 1 # Названия организаций загружаются один раз, а не на каждый заказ
+
+
+def test_orders_are_read_without_expand_above_100(serve):
+    server = serve(generate_rows(10))
+    list(api_for(server, token='fake').read_rows('2022-01-15'))
+
+    for path, query, auth in server.requests:
+        if int(query.get('limit', ['0'])[0]) > 100:
+            assert 'expand' not in query
+
+
+def test_unlisted_organization_is_resolved_by_href(serve):
+    rows = [('ИП Ермалович', 'ART-1'), ('ИП Новый', 'ART-2')]
+    server = serve(rows, listed_organizations=['ИП Ермалович'])
+
+    assert api_for(server, token='fake').get_frequency_dict('2022-01-15') == count_orders(rows)
+    assert [path for path, query, auth in server.requests].count('/entity/organization/1') == 1
+
+
+def test_filter_and_authorization(serve):
+    server = serve(generate_rows(5))
+    list(api_for(server, token='secret', states=('Новый', 'Собран')).read_rows('2022-01-15'))
+    list(api_for(server, login='admin@shop', password='password').read_rows('2022-01-15'))
+
+    (path, query, auth), = [request for request in server.requests[:2] if request[0] == '/entity/customerorder']
+    assert query['filter'] == ['moment>=2022-01-15 00:00:00;moment<=2022-01-15 23:59:59;state.name=Новый;state.name=Собран']
+    assert auth == 'Bearer secret'
+    assert server.requests[-1][2].startswith('Basic ')
+
+
+@pytest.fixture
+def moysklad(serve, tmp_path, monkeypatch):
+    """
+    Фейковый МоегоСклад вместо настоящего API для команд бота; запуск в tmp_path, запись в таблицы отключена
+    """
+
+    server = serve(generate_rows(5))
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(bot, 'MOYSKLAD_API_URL', f'http://127.0.0.1:{server.server_port}')
+    monkeypatch.setenv('MOYSKLAD_TOKEN', 'fake')
+    monkeypatch.delenv('MOYSKLAD_STATES', raising=False)
+    monkeypatch.setattr(bot.Spreadsheet, 'run', lambda self, frequency_dictionary, day=None: None)
+    monkeypatch.setattr(bot.Spreadsheet, 'backfill', lambda self, frequency_by_day: None)
+    return server
+
+
+def sent_filters(server):
+    return [query['filter'][0] for path, query, auth in server.requests if path == '/entity/customerorder']
+
+
+def expected_filter(day, *states):
+    return ';'.join([f'moment>={day} 00:00:00', f'moment<={day} 23:59:59'] + [f'state.name={state}' for state in states])
+
+
+def test_api_command_sends_states_from_command_line(moysklad, monkeypatch):
+    monkeypatch.setenv('MOYSKLAD_STATES', 'Отменен')
+    bot.main(['api', '--state', 'Новый', '--state', 'Собран'])
+    assert sent_filters(moysklad) == [expected_filter(bot.yesterday(), 'Новый', 'Собран')]
+
+
+def test_backfill_sends_states_from_environment(moysklad, monkeypatch):
+    monkeypatch.setenv('MOYSKLAD_STATES', 'Новый, Собран')
+    bot.main(['backfill', '2022-01-15', '2022-01-16', '--source', 'api'])
+    assert sent_filters(moysklad) == [expected_filter('2022-01-15', 'Новый', 'Собран'), expected_filter('2022-01-16', 'Новый', 'Собран')]
+
+
+def test_api_command_without_states_counts_all_orders(moysklad):
+    bot.main(['api'])
+    assert sent_filters(moysklad) == [expected_filter(bot.yesterday())]
+
+
+def test_job_sends_its_states(moysklad):
+    Job('shop', source='api', states=['Собран']).frequency_dictionary(datetime.date(2022, 1, 15), None, RunMetrics(), None)
+    assert sent_filters(moysklad) == [expected_filter('2022-01-15', 'Собран')]
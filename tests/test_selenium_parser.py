@@ -0,0 +1,101 @@
+import datetime
+import pathlib
+
+import pytest
+
+from bot import HistoryStore, PaginationError, SeleniumParser
+
+
+FIXTURE = pathlib.Path(__file__).parent / 'fixtures' / 'moysklad_orders.html'
+DAY = datetime.date(2022, 1, 15)
+
+
+@pytest.fixture(scope='module')
+def browser():
+    webdriver = pytest.importorskip('selenium.webdriver')
+    from selenium.common.exceptions import WebDriverException
+
+    options = webdriver.ChromeOptions()
+    options.add_argument('--headless=new')
+    try:
+        browser = webdriver.Chrome(options=options)
+    except WebDriverException as error:
+        pytest.skip(f'Нет Chrome или chromedriver: {error.msg}')
+    yield browser
+    browser.quit()
+
+
+def make_parser(browser, tmp_path, timeout=5):
+    from selenium.webdriver.support.ui import WebDriverWait
+
+    parser = SeleniumParser(None, None, history=HistoryStore(str(tmp_path / 'history.sqlite3')), day=DAY)
+    parser.browser = browser
+    parser.wait = WebDriverWait(browser, timeout)
+    return parser
+
+
+def open_fixture(parser, query=''):
+    parser.browser.get(FIXTURE.as_uri() + query)
+    return parser.wait_table_refresh(None)
+
+
+def test_all_pages_are_scraped(browser, tmp_path):
+    parser = make_parser(browser, tmp_path)
+    assert open_fixture(parser)
+
+    parser.scrape_pages()
+    assert len(list(parser.history.read_orders(str(DAY)))) == 8
+
+
+def test_rescrape_replaces_orders_of_the_day(browser, tmp_path):
+    parser = make_parser(browser, tmp_path)
+    assert open_fixture(parser)
+    parser.scrape_pages()
+
+    parser = make_parser(browser, tmp_path)
+    assert open_fixture(parser)
+    parser.scrape_pages()
+    assert len(list(parser.history.read_orders(str(DAY)))) == 8
+
+
+def test_interrupted_scrape_keeps_history_unchanged(browser, tmp_path):
+    parser = make_parser(browser, tmp_path, timeout=1)
+    parser.history.write_orders(str(DAY), [('ИП Ермалович', 'ART-9')])
+    assert open_fixture(parser, '?stuck')
+
+    with pytest.raises(PaginationError):
+        parser.scrape_pages()
+    assert list(parser.history.read_orders(str(DAY))) == [('ИП Ермалович', 'ART-9')]
+
+
+def test_empty_table_placeholder_means_no_orders(browser, tmp_path):
+    parser = make_parser(browser, tmp_path)
+    assert not open_fixture(parser, '?empty')
+
+
+def test_table_without_rows_after_refresh_means_no_orders(browser, tmp_path):
+    parser = make_parser(browser, tmp_path)
+    assert open_fixture(parser)
+
+    old_row = parser.first_table_row()
+    browser.execute_script('refresh([])')
+    parser.wait = make_parser(browser, tmp_path, timeout=1).wait
+    assert not parser.wait_table_refresh(old_row)
+
+
+def test_stuck_pager_raises_pagination_error(browser, tmp_path):
+    parser = make_parser(browser, tmp_path, timeout=1)
+    assert open_fixture(parser, '?stuck')
+
+    with pytest.raises(PaginationError):
+        parser.scrape_pages()
+
+
+def test_order_columns_skip_first_and_last_column_cells(browser, tmp_path):
+    parser = make_parser(browser, tmp_path)
+    assert open_fixture(parser)
+
+    parser.parse_data()
+    assert parser.parsed_rows == [
+        ('ИП Ермалович', 'ART-1'), ('ИП Александров', 'ART-2'), ('ИП Ермалович', 'ART-1'),
+    ]
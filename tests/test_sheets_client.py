@@ -0,0 +1,95 @@
+import gspread
+import pytest
+
+from fakes import FakeBackend, FakeResponse, generate_calculation_sheet
+from bot import SheetsClient, Spreadsheet, TokenBucket
+
+
+def fast_client(max_retries=10):
+    return SheetsClient(bucket=TokenBucket(rate=10_000, period=1.0), max_retries=max_retries, backoff_base=0.001, backoff_cap=0.01)
+
+
+def failing(code, calls):
+    def function():
+        calls.append(code)
+        raise gspread.exceptions.APIError(FakeResponse(code, 'fake'))
+    return function
+
+
+def test_margin_index_is_complete_despite_429():
+    expected = Spreadsheet(fast_client()).build_margin_index(generate_calculation_sheet(FakeBackend()).worksheets())
+
+    backend = FakeBackend(error_rate=0.3)
+    client = fast_client()
+    worksheets = client.call('worksheets', generate_calculation_sheet(backend).worksheets)
+    margin_index = Spreadsheet(client).build_margin_index(worksheets)
+
+    assert backend.errors > 0
+    assert margin_index == expected
+    assert client.stats()['retried'] == backend.errors
+
+
+def test_retries_stop_at_max_retries_and_reraise():
+    calls = []
+    client = fast_client(max_retries=3)
+    with pytest.raises(gspread.exceptions.APIError) as error:
+        client.call('get_all_values', failing(429, calls))
+
+    assert error.value.code == 429
+    assert len(calls) == 4
+    assert client.stats()['retried'] == 3
+
+
+@pytest.mark.parametrize('code', [400, 403, 404])
+def test_non_retryable_error_is_raised_immediately(code):
+    calls = []
+    client = fast_client()
+    with pytest.raises(gspread.exceptions.APIError):
+        client.call('get_all_values', failing(code, calls))
+
+    assert calls == [code]
+    assert client.stats()['retried'] == 0
+
+
+@pytest.mark.parametrize('code', [500, 503])
+def test_server_errors_are_retried(code):
+    calls = []
+    answers = iter([code, code])
+
+    def flaky():
+        for answer in answers:
+            calls.append(answer)
+            raise gspread.exceptions.APIError(FakeResponse(answer, 'fake'))
+        return 'ok'
+
+    assert fast_client().call('get_all_values', flaky) == 'ok'
+    assert calls == [code, code]
+
+
+def test_bucket_allows_at_most_rate_calls_in_any_window():
+    import threading
+    from time import perf_counter
+
+    rate, period = 5, 0.5
+    bucket = TokenBucket(rate=rate, period=period)
+    times = []
+    lock = threading.Lock()
+
+    def call():
+        for _ in range(3):
+            bucket.acquire()
+            with lock:
+                times.append(perf_counter())
+
+    threads = [threading.Thread(target=call) for _ in range(5)]
+    start = perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    times.sort()
+    assert len([moment for moment in times if moment - start < period * 0.9]) == rate # Первая квота сразу, без ожидания
+    for moment in times:
+        assert len([other for other in times if moment <= other < moment + period * 0.9]) <= rate
+    assert times[-1] - start >= 2 * period * 0.9
@@ -0,0 +1,166 @@
+import argparse
+import datetime
+from collections import Counter
+
+import pytest
+
+import bot
+from fakes import FakeBackend, generate_calculation_sheet, generate_statistics_sheet, write_excel_export
+from bot import HistoryStore, RunMetrics, Spreadsheet, cell_matches, count_orders, date_range, run_command, yesterday
+
+
+DAY = datetime.date(2022, 1, 15)
+
+
+@pytest.fixture
+def sheets(tmp_path, make_pool):
+    backend = FakeBackend()
+    calculation = generate_calculation_sheet(backend, sheets=2, articles=5)
+    statistics = generate_statistics_sheet(backend, articles=10)
+    history = HistoryStore(str(tmp_path / 'history.sqlite3'))
+    pool = make_pool(calculation, statistics)
+    spread = Spreadsheet(pool=pool, history=history)
+    return spread, statistics._worksheets[1], backend
+
+
+def test_backfill_skips_days_without_orders(sheets, capsys, count_cell):
+    spread, worksheet, backend = sheets
+    empty_day = DAY + datetime.timedelta(days=1)
+    spread.history.write_margin_orders(str(empty_day), [('ИП А', 'ART-2', 100.0, 1, 500.0, 'да')])
+
+    spread.backfill({DAY: count_orders([('ИП А', 'ART-1'), ('ИП Б', 'ART-1')]), empty_day: Counter()})
+
+    assert count_cell(worksheet, 'ART-1', DAY) == '2'
+    assert spread.history.read_day_statistics(str(empty_day)) == {'ART-2': (100.0, 1, 500.0, 'да')}
+    assert f'За {empty_day} нет заказов' in capsys.readouterr().out
+
+
+def test_history_backfill_of_a_day_without_parsed_orders_changes_nothing(sheets):
+    spread, worksheet, backend = sheets
+    spread.history.write_margin_orders(str(DAY), [('ИП А', 'ART-2', 100.0, 1, 500.0, 'да')])
+
+    args = argparse.Namespace(command='backfill', start=DAY, end=DAY, source='history')
+    run_command(args, spread, spread.history, RunMetrics())
+
+    assert backend.requests == 0
+    assert spread.history.read_day_statistics(str(DAY)) == {'ART-2': (100.0, 1, 500.0, 'да')}
+
+
+def test_excel_orders_are_recorded_for_backfill(sheets, tmp_path):
+    spread, worksheet, backend = sheets
+    folder = tmp_path / 'Excel'
+    folder.mkdir()
+    write_excel_export(str(folder / 'orders.xls'), [('ИП А', 'ART-1'), ('ИП А', 'ART-3')])
+
+    run_command(argparse.Namespace(command='excel', folder=str(folder)), spread, spread.history, RunMetrics())
+
+    orders = list(spread.history.read_orders(str(yesterday())))
+    assert ('ИП А', 'ART-1') in orders and ('ИП А', 'ART-3') in orders
+    assert list(folder.iterdir()) == []
+
+
+def test_period_across_two_months_is_rejected(sheets):
+    spread, worksheet, backend = sheets
+    days = date_range(datetime.date(2022, 1, 28), datetime.date(2022, 2, 3)) # Числа месяца не повторяются
+
+    with pytest.raises(ValueError, match='01.2022, 02.2022'):
+        spread.update_statistics_table(days)
+    assert backend.requests == 0
+
+
+def test_backfill_across_two_months_fails_before_fetching_orders(sheets, monkeypatch):
+    spread, worksheet, backend = sheets
+    created = []
+    monkeypatch.setattr(bot, 'MoySkladAPI', lambda *args, **kwargs: created.append(kwargs))
+
+    args = argparse.Namespace(command='backfill', start=datetime.date(2022, 1, 28), end=datetime.date(2022, 2, 3), source='api')
+    with pytest.raises(ValueError):
+        run_command(args, spread, spread.history, RunMetrics())
+    assert created == []
+    assert backend.requests == 0
+
+
+@pytest.mark.parametrize('current, value, matches', [
+    ('203', '203,0', True), # Таблица показывает числа в своем формате
+    ('203,5', '203,50', True),
+    ('203', '203,5', False),
+    ('да', 'да', True),
+    ('да', 'нет', False),
+    ('', '0', False),
+    (None, '', True), # Ячейка за пределами прочитанной страницы пустая
+])
+def test_cell_matches(current, value, matches):
+    values = [['ART-1', current]] if current is not None else [['ART-1']]
+    assert cell_matches(values, 1, 2, value) is matches
+
+
+def test_pending_cells_are_replaced_and_cleared_per_page(tmp_path):
+    history = HistoryStore(str(tmp_path / 'history.sqlite3'))
+    history.save_pending_cells('a/1', [(1, 1, 'старое'), (1, 2, 'x')])
+    history.save_pending_cells('a/1', [(2, 1, '1'), (2, 2, '2'), (2, 3, '3')])
+    history.save_pending_cells('b/1', [(2, 1, 'другая страница')])
+
+    history.clear_pending_cells('a/1', [(2, 1, '1'), (2, 3, '3')])
+    assert history.read_pending_cells('a/1') == [(2, 2, '2')]
+    assert history.read_pending_cells('b/1') == [(2, 1, 'другая страница')]
+
+
+def test_pending_cells_are_merged_into_the_new_plan(sheets, count_cell):
+    spread, worksheet, backend = sheets
+    spread.history.write_margin_orders(str(DAY), [('ИП А', 'ART-1', 100.0, 2, 500.0, 'да')])
+    checkpoint = f'{spread.statistics_id}/{worksheet.id}'
+    count_row = next(row for row, line in enumerate(worksheet.values, start=1) if line[0] == 'ART-1')
+    day_col = DAY.day + 1
+    spread.history.save_pending_cells(checkpoint, [
+        (count_row, day_col, '7'), # Устаревшее значение той же ячейки: новый план важнее
+        (count_row + 5, day_col, '3'), # Ячейка, которую прерванный запуск не успел записать
+    ])
+
+    spread.update_statistics_table([DAY])
+
+    assert count_cell(worksheet, 'ART-1', DAY) == '2'
+    assert worksheet.values[count_row + 4][day_col - 1] == '3'
+    assert spread.history.read_pending_cells(checkpoint) == []
+
+
+class Killed(Exception):
+    pass
+
+
+def test_interrupted_write_is_resumed_and_then_has_nothing_to_write(tmp_path, make_pool, monkeypatch):
+    monkeypatch.setattr(bot, 'BATCH_UPDATE_SIZE', 100)
+    backend = FakeBackend()
+    statistics = generate_statistics_sheet(backend, articles=300)
+    worksheet = statistics._worksheets[1]
+    history = HistoryStore(str(tmp_path / 'history.sqlite3'))
+    history.write_margin_orders(str(DAY), [('ИП А', f'ART-{article}', 100.5, 1, 500.0, 'да') for article in range(300)])
+    checkpoint = f'{statistics.id}/{worksheet.id}'
+
+    batches = [] # Размеры пачек, записанных текущим запуском
+    kill_on = None
+    batch_update = worksheet.batch_update
+
+    def flaky_batch_update(data, value_input_option=None):
+        if len(batches) + 1 == kill_on:
+            raise Killed()
+        batches.append(len(data))
+        batch_update(data, value_input_option)
+
+    worksheet.batch_update = flaky_batch_update
+
+    def run(kill=None):
+        nonlocal kill_on
+        kill_on = kill
+        batches.clear()
+        Spreadsheet(pool=make_pool(statistics), history=history).update_statistics_table([DAY])
+        return list(batches)
+
+    with pytest.raises(Killed):
+        run(kill=3) # 1200 ячеек: 300 товаров по 4 строки
+    assert batches == [100, 100]
+    assert len(history.read_pending_cells(checkpoint)) == 1000
+
+    assert run() == [100] * 10
+    assert history.read_pending_cells(checkpoint) == []
+
+    assert run() == []